@@ -0,0 +1,72 @@
+"""
+Time the cold import of each utils module, each in a fresh Python process.
+
+    python benchmarks/import_times.py [--path DIR] [--repeat N]
+
+`--path` is the data-processing directory whose utils package is imported,
+by default the one containing this script. To compare with an older
+revision, check it out elsewhere, e.g. with `git worktree add`, and pass its
+data-processing directory.
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import subprocess
+
+modules = ('utils.utils',
+           'utils.vocabulary',
+           'utils.datautils',
+           'utils.textutils',
+           'utils.processing',
+           'utils.topicmodels',
+           'utils.build')
+
+timer = '''
+import sys, time
+sys.path.insert(0, %r)
+start = time.time()
+try:
+    import %s
+except ImportError as e:
+    print('ImportError: %%s' %% e)
+else:
+    print(time.time() - start)
+'''
+
+
+def time_import(module, path):
+
+    output = subprocess.check_output([sys.executable, '-c', timer % (path, module)])
+    output = output.decode('utf-8').strip()
+
+    try:
+        return float(output)
+    except ValueError:
+        return output
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--path',
+                        default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for module in modules:
+
+        times = [time_import(module, args.path) for _ in range(args.repeat)]
+
+        errors = [t for t in times if not isinstance(t, float)]
+        if errors:
+            print('%-20s %s' % (module, errors[0]))
+        else:
+            print('%-20s %7.3f s (best of %d)' % (module, min(times), args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Parity of utils.tokenize and utils.tokenize_many with the original
+implementation of tokenize, which is kept here as the reference.
+
+Run from the data-processing directory with
+
+    python -m unittest discover -s tests
+
+"""
+
+import re
+import random
+import string
+import unittest
+
+from utils import utils
+
+
+def reference_tokenize(text, foldcase=True):
+
+    text = re.sub(r'\'s','', text)
+    s = ''.join([s for s in text if s in string.printable])
+
+    s = str(s) # Got to convert it to str.
+    s = s.translate(string.maketrans("",""), string.punctuation)
+
+    if foldcase:
+        s = s.lower()
+    return s.split()
+
+
+def random_texts(n, seed=101):
+
+    random_state = random.Random(seed)
+
+    alphabet = (string.printable
+                + ''.join(map(chr, range(128, 256)))
+                + "'s" * 10)
+    unicode_alphabet = (unicode(string.printable)
+                        + u''.join(map(unichr, range(128, 400)))
+                        + u"'s" * 10)
+
+    texts = []
+    for i in xrange(n):
+        characters = alphabet if i % 2 else unicode_alphabet
+        length = random_state.randint(0, 60)
+        texts.append(''.join(random_state.choice(characters)
+                             for _ in xrange(length)))
+
+    return texts
+
+
+class TestTokenizeParity(unittest.TestCase):
+
+    def test_tokenize(self):
+
+        for text in random_texts(20000):
+            for foldcase in (True, False):
+                self.assertEqual(utils.tokenize(text, foldcase=foldcase),
+                                 reference_tokenize(text, foldcase=foldcase),
+                                 repr(text))
+
+    def test_tokenize_many(self):
+
+        texts = random_texts(5000, seed=102)
+
+        for foldcase in (True, False):
+            self.assertEqual(utils.tokenize_many(texts, foldcase=foldcase),
+                             [reference_tokenize(text, foldcase=foldcase)
+                              for text in texts])
+
+    def test_examples(self):
+
+        for text in ["The dog's bone.", u"Caf\xe9 it's", '', "'s's", 'a\x00b']:
+            self.assertEqual(utils.tokenize(text), reference_tokenize(text))
+            self.assertEqual(utils.tokenize_many([text]), [reference_tokenize(text)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,346 @@
+"""
+A small build system for the derived corpus artifacts: BNC xml files to
+paragraphs, to vocabulary counts, to texts.
+
+Each stage's outputs are stored in a directory named by a key that hashes
+everything that determines them: the source of the stage's function and of
+all the code of the package that it uses, its parameters, the checksums of its input
+files, and the keys of the stages it depends on. File paths are not part of
+the key, so moving the input files does not cause a rebuild.
+A stage is only run if the directory for its current key does not exist, so
+only the stages whose inputs have changed, and those downstream of them, are
+rebuilt.
+
+"""
+
+#=============================================================================
+# Standard library imports
+#=============================================================================
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+
+#=============================================================================
+# Local imports
+#=============================================================================
+from . import utils
+from . import textutils
+
+#================================ End Imports ================================
+
+result_filename = 'result.json'
+
+
+class Stage(object):
+
+    """
+    A build stage. Its `function` is called as
+
+        function(output_directory, inputs, input_files, **parameters)
+
+    where `inputs` is the list of the outputs of each of its `dependencies`.
+    It writes its outputs in `output_directory` and returns the list of their
+    filenames. The function must be defined at module level, so that it can
+    be run in a worker process. It must only read the files in `input_files`
+    and `inputs`, as only those are tracked.
+
+    """
+
+    def __init__(self, name, function, dependencies=(), input_files=(),
+                 parameters=None):
+
+        self.name = name
+        self.function = function
+        self.dependencies = list(dependencies)
+        self.input_files = list(input_files)
+        self.parameters = parameters or {}
+
+
+def _run_stage(function_output_directory_inputs_input_files_parameters):
+
+    function, output_directory, inputs, input_files, parameters\
+        = function_output_directory_inputs_input_files_parameters
+
+    return [os.path.relpath(filename, output_directory)
+            for filename in function(output_directory,
+                                     inputs,
+                                     input_files,
+                                     **parameters)]
+
+
+class BuildGraph(object):
+
+    """
+    A graph of build stages whose outputs are kept in `build_directory`.
+
+    """
+
+    def __init__(self, build_directory, processes=None):
+
+        self.build_directory = build_directory
+        self.processes = processes
+        self.stages = []
+        self.checksum_cache = utils.ChecksumCache(
+            os.path.join(build_directory, utils.checksum_cache_filename))
+
+    def add(self, stage):
+
+        for dependency in stage.dependencies:
+            assert dependency in self.stages, 'Add dependencies first.'
+
+        self.stages.append(stage)
+
+        return stage
+
+    def _get_key(self, stage, keys):
+
+        h = hashlib.sha256()
+
+        h.update(utils.get_code_key(stage.function))
+
+        h.update(json.dumps(stage.parameters, sort_keys=True))
+
+        for filename in stage.input_files:
+            h.update(self.checksum_cache.checksum(filename))
+
+        for dependency in stage.dependencies:
+            h.update(keys[dependency])
+
+        return h.hexdigest()
+
+    def _get_output_directory(self, key):
+
+        return os.path.join(self.build_directory, key[:2], key)
+
+    def _read_result(self, key):
+
+        output_directory = self._get_output_directory(key)
+
+        with open(os.path.join(output_directory, result_filename)) as f:
+            return [os.path.join(output_directory, filename)
+                    for filename in json.load(f)]
+
+    def _is_built(self, key):
+
+        return os.path.exists(os.path.join(self._get_output_directory(key),
+                                           result_filename))
+
+    def _get_waves(self):
+
+        """
+        Group the stages into waves, each of which depends only on the
+        stages in earlier waves.
+
+        """
+
+        depth = {}
+        for stage in self.stages: # Stages are added after their dependencies.
+            depth[stage] = 1 + max([depth[dependency]
+                                    for dependency in stage.dependencies] + [-1])
+
+        waves = [[] for _ in xrange(max(depth.values()) + 1)]
+        for stage in self.stages:
+            waves[depth[stage]].append(stage)
+
+        return waves
+
+    def build(self, verbose=False):
+
+        """
+        Run every stage whose outputs for its current key do not exist yet.
+        The stages of each wave are run in parallel by a pool of `processes`
+        processes, unless only one needs to be run, in which case it is run
+        in this process and is free to use a pool itself.
+
+        Return a dictionary giving the output filenames of each stage name.
+
+        """
+
+        utils.mkdir_p(self.build_directory)
+
+        try:
+            return self._build(verbose=verbose)
+        finally:
+            self.checksum_cache.save()
+
+    def _build(self, verbose=False):
+
+        keys = {}
+        results = {}
+
+        for wave in self._get_waves():
+
+            stale = []
+            stale_keys = set()
+            for stage in wave:
+                keys[stage] = self._get_key(stage, keys)
+                # Stages with the same key have the same outputs, so build one.
+                if not self._is_built(keys[stage]) and keys[stage] not in stale_keys:
+                    stale.append(stage)
+                    stale_keys.add(keys[stage])
+
+            if verbose:
+                print('%d of %d stages to build: %s' % (len(stale),
+                                                        len(wave),
+                                                        ', '.join([stage.name for stage in stale])))
+
+            tmp_directories = [tempfile.mkdtemp(dir=self.build_directory)
+                               for _ in stale]
+            for tmp_directory in tmp_directories:
+                utils.set_default_permissions(tmp_directory)
+
+            arguments = [(stage.function,
+                          tmp_directory,
+                          [results[dependency.name] for dependency in stage.dependencies],
+                          stage.input_files,
+                          stage.parameters)
+                         for stage, tmp_directory in zip(stale, tmp_directories)]
+
+            try:
+
+                if len(stale) > 1 and self.processes != 1:
+
+                    pool = multiprocessing.Pool(self.processes)
+                    try:
+                        stage_results = pool.map(_run_stage, arguments)
+                        pool.close()
+                    except:
+                        pool.terminate()
+                        raise
+                    finally:
+                        pool.join()
+
+                else:
+                    stage_results = map(_run_stage, arguments)
+
+            except:
+                for tmp_directory in tmp_directories:
+                    shutil.rmtree(tmp_directory, ignore_errors=True)
+                raise
+
+            for stage, tmp_directory, stage_result in zip(stale,
+                                                          tmp_directories,
+                                                          stage_results):
+
+                with open(os.path.join(tmp_directory, result_filename), 'w') as f:
+                    json.dump(stage_result, f)
+
+                output_directory = self._get_output_directory(keys[stage])
+                utils.mkdir_p(os.path.dirname(output_directory))
+                os.rename(tmp_directory, output_directory)
+
+            for stage in wave:
+                results[stage.name] = self._read_result(keys[stage])
+
+        return results
+
+
+#=============================================================================
+# The BNC stages
+#=============================================================================
+
+def extract_paragraphs(output_directory, inputs, input_files):
+
+    xmlfilename, = input_files
+
+    shard_filename = os.path.join(output_directory, 'paragraphs.pkl')
+
+    textutils.dump(textutils.get_all_paragraphs(xmlfilename), shard_filename)
+
+    return [shard_filename]
+
+
+def count_vocabulary(output_directory, inputs, input_files, stopwords_lists):
+
+    """
+    Count the corpus vocabulary, and write the counts and, as a list, the
+    words that occur. The first `stopwords_lists` input files are the
+    stopwords lists, and the rest the vocabulary lists.
+
+    """
+
+    shard_filenames = [shard_filename for (shard_filename,) in inputs]
+
+    def read_wordlists(filenames):
+        return set.union(*[set(textutils._read_wordlist(filename, directory=''))
+                           for filename in filenames])
+
+    vocab = textutils.Vocab(vocab=read_wordlists(input_files[stopwords_lists:]),
+                            stopwords=read_wordlists(input_files[:stopwords_lists]))
+
+    counts = textutils._count_words(textutils.iter_shards(shard_filenames), vocab)
+    word_counter = dict(zip(vocab.vocab, counts.tolist()))
+
+    words = sorted(word for word, count in word_counter.items() if count > 0)
+
+    counts_filename = os.path.join(output_directory, 'word_counts.json')
+    with open(counts_filename, 'w') as f:
+        json.dump(word_counter, f)
+
+    vocabulary_filename = os.path.join(output_directory,
+                                       'bnc_vocab_%d.txt' % len(words))
+    with open(vocabulary_filename, 'w') as f:
+        f.write('\n'.join(words))
+
+    return [counts_filename, vocabulary_filename]
+
+
+def write_texts(output_directory, inputs, input_files, min_length, max_length):
+
+    """
+    Segment the paragraphs into texts using the vocabulary from
+    count_vocabulary, which is the last input.
+
+    """
+
+    shard_filenames = [shard_filename for (shard_filename,) in inputs[:-1]]
+    _, vocabulary_filename = inputs[-1]
+
+    vocab = textutils._Vocab(open(vocabulary_filename).read().split())
+
+    return textutils.write_texts(textutils.iter_shards(shard_filenames),
+                                 vocab,
+                                 output_directory,
+                                 min_length=min_length,
+                                 max_length=max_length)
+
+
+def get_bnc_build_graph(xmlfilenames, build_directory, min_length=251,
+                        max_length=499, processes=None):
+
+    """
+    Return the build graph from the BNC xml files to the segmented texts.
+    The paragraph extraction depends only on each xml file, so changing the
+    stopword or vocabulary lists only reruns the counting and segmentation.
+
+    """
+
+    graph = BuildGraph(build_directory, processes=processes)
+
+    paragraphs_stages = [graph.add(Stage('paragraphs:%s' % xmlfilename,
+                                         extract_paragraphs,
+                                         input_files=[xmlfilename]))
+                         for xmlfilename in xmlfilenames]
+
+    stopwords_filenames = [os.path.join(textutils.vocabulary_directory, filename)
+                           for filename in textutils.stopwords_lists_filenames]
+    vocabulary_filenames = [os.path.join(textutils.vocabulary_directory, filename)
+                            for filename in textutils.vocabulary_filenames]
+
+    vocabulary_stage = graph.add(Stage('vocabulary',
+                                       count_vocabulary,
+                                       dependencies=paragraphs_stages,
+                                       input_files=stopwords_filenames
+                                       + vocabulary_filenames,
+                                       parameters=dict(stopwords_lists=len(stopwords_filenames))))
+
+    graph.add(Stage('texts',
+                    write_texts,
+                    dependencies=paragraphs_stages + [vocabulary_stage],
+                    parameters=dict(min_length=min_length,
+                                    max_length=max_length)))
+
+    return graph
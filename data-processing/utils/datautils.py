@@ -1,73 +1,60 @@
 from __future__ import absolute_import, division
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from scipy import sparse
-import string
-import re
 import numpy
 import os
-import bz2
 
+from . import utils
+from .vocabulary import Vocab
+from .utils import deletechars, deletepunctuation, tokenize, tokenize_many
 
-def deletechars(s, exclude_chars):
-    ''' Fast deletion of characters from string.
-    It uses a dummy translation table, and so no mapping is applied, and we
-    just delete the exclude_chars characters.
-    '''
-    phony_translate_table = string.maketrans("","")
-    return s.translate(phony_translate_table, exclude_chars)
 
+class LRUCache(object):
 
-def deletepunctuation(s):
-    ''' Fast deletion of punctuation from string'''
-    return deletechars(s,string.punctuation)
+    '''
+    A dictionary-like cache holding at most `maxsize` items, discarding the
+    least recently used ones first. Counts its hits and misses.
+    '''
 
+    def __init__(self, maxsize=128):
 
-def tokenize(text, foldcase=True):
-    ''' 
-    A very cheap and easy tokenization.
-    First, remove "'s". For example, "dog's" becomes "dog".
-    Second, zap utf-8 chars.
-    Then, remove all punctuation and, by default, fold upper and lower case words
-    and then split by whitespace.
-    '''
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
-    text = re.sub(r'\'s','', text)
-    s = ''.join([s for s in text if s in string.printable])
+    def get(self, key, default=None):
 
-    s = str(s) # Got to convert it to str.
-    s = deletepunctuation(s)
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
 
-    if foldcase:
-        s = s.lower()
-    return s.split()
+        self.items[key] = value # Reinsert as the most recently used.
+        self.hits += 1
+        return value
 
+    def put(self, key, value):
 
-class Vocab(object):
+        self.items.pop(key, None)
+        self.items[key] = value
 
-    '''
-    A simple vocabulary class
-    '''
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
 
-    def __init__(self, vocab):
+    def clear(self):
 
-        """
-        vocab should be a list
-        
-        """
+        self.items.clear()
 
-        word2index = {word:i for i, word in enumerate(vocab)}
-        index2word = {i:word for i, word in enumerate(vocab)}
+    def __len__(self):
 
-        for key in word2index:
-            assert index2word[word2index[key]] == key
+        return len(self.items)
 
-        for key in index2word:
-            assert word2index[index2word[key]] == key
+    def __contains__(self, key):
 
-        self.vocab = vocab
-        self.word2index = word2index
-        self.index2word = index2word
+        return key in self.items
 
 
 class Cooccurrences(object):
@@ -76,12 +63,14 @@ class Cooccurrences(object):
     Class for getting co-occurrence joint and conditional probabilities.
     """
 
-    def __init__(self, filename, cache, vocab):
+    def __init__(self, filename, cache, vocab, profile_cache_size=128):
 
         self.filename = filename
         self.cache = cache
         self.vocabulary = vocab
         self.initialized = False
+        self.profile_cache = LRUCache(profile_cache_size)
+        self.conditional_probabilities = None
 
         self.texts = self.load_text(self.filename, self.cache)
         self.calculate_word_counts()
@@ -89,36 +78,7 @@ class Cooccurrences(object):
 
     def load_text(self, filename, cache, verbose=False):
 
-        local_filepath = os.path.join(cache, filename)
-
-        basename, extension = os.path.splitext(local_filepath)
-
-        if extension == '.bz2':
-
-            if os.path.exists(basename):
-
-                if verbose:
-                    print('%s already exists. Skipping uncompression.' % 
-                          os.path.basename(basename))
-
-            else:
-
-                if verbose:
-                    print('Uncompressing %s to %s' % (filename, basename))
-
-                # Read bunzipped data to tmp_data
-                with bz2.BZ2File(local_filepath) as f:
-                    tmp_data = f.read()
-
-                # Write tmp_data to filename without bz2 extension
-                with open(basename, 'wb') as f:
-                    f.write(tmp_data)
-
-            return open(basename).read().strip().split('\n')
-
-        else:
-            raise Exception('Expecting a bz2 file.')
-
+        return utils.loadcsv(filename, cache, verbose=verbose)
 
     def calculate_word_counts(self):
 
@@ -134,17 +94,18 @@ class Cooccurrences(object):
                 counts[word] += 1
         return counts
 
-    def calculate_cooccurrences(self):
+    def get_count_matrix(self, counts):
 
         '''
-        Return sparse VxV matrix giving coccurrence counts (frequencies).
+        Return sparse JxV matrix giving the word counts in each of the J texts
+        whose counts are in `counts`.
         '''
 
         rows = []
         cols = []
         values = []
 
-        for j, counts_text_j in enumerate(self.counts):
+        for j, counts_text_j in enumerate(counts):
             for key, value in counts_text_j.iteritems():
                 try:
                     cols.append(self.vocabulary.word2index[key])
@@ -153,32 +114,521 @@ class Cooccurrences(object):
                 except KeyError:
                     pass
 
-        self.count_matrix =  sparse.csr_matrix((values, (rows, cols)),
-                                               shape=(len(self.counts),
-                                                      len(self.vocabulary.word2index)))
+        return sparse.csr_matrix((values, (rows, cols)),
+                                 shape=(len(counts),
+                                        len(self.vocabulary.word2index)))
+
+    @staticmethod
+    def get_cooccurrence_counts(count_matrix):
 
-        C = self.count_matrix.T.dot(self.count_matrix)
-        C.setdiag((self.count_matrix.power(2) - self.count_matrix).multiply(0.5).sum(0).A.flatten())
+        '''
+        Return sparse VxV matrix giving coccurrence counts (frequencies) of
+        the texts in `count_matrix`. The diagonal is the number of pairs of
+        tokens of the same word, so texts' contributions are additive.
+        '''
 
-        mj = self.count_matrix.sum(1)
+        C = count_matrix.T.dot(count_matrix).tocsr()
+        C.setdiag((count_matrix.power(2) - count_matrix).multiply(0.5).sum(0).A.flatten())
+
+        mj = count_matrix.sum(1)
         assert sparse.triu(C).sum() == ((mj.A**2 - mj.A)/2).sum()
 
-        self.C = C
+        return C
+
+    def calculate_cooccurrences(self):
+
+        '''
+        Return sparse VxV matrix giving coccurrence counts (frequencies).
+        '''
+
+        self.count_matrix = self.get_count_matrix(self.counts)
+        self.C = self.get_cooccurrence_counts(self.count_matrix)
+
+    def add_texts(self, texts):
+
+        '''
+        Add the cooccurrence counts of new texts to `C`. Like those in the
+        text file, the texts are "|" delimited strings of words. Only the new
+        texts are counted, so the cost is proportional to their size.
+        '''
+
+        texts = list(texts)
+        counts = [self.get_word_counts_per_text(text) for text in texts]
+        count_matrix = self.get_count_matrix(counts)
+
+        self.C = self.C + self.get_cooccurrence_counts(count_matrix)
+        self.count_matrix = sparse.vstack([self.count_matrix, count_matrix],
+                                          format='csr')
+
+        self.texts.extend(texts)
+        self.counts.extend(counts)
+
+        self.profile_cache.clear()
+        self.conditional_probabilities = None
+
+    def save(self, filename):
+
+        '''
+        Save the cooccurrence and text count matrices to the npz `filename`.
+        Use `load` to restore them, and then `add_texts` to update them.
+        '''
+
+        arrays = {}
+        for name, matrix in (('C', self.C), ('count_matrix', self.count_matrix)):
+            matrix = sparse.csr_matrix(matrix)
+            arrays[name + '_data'] = matrix.data
+            arrays[name + '_indices'] = matrix.indices
+            arrays[name + '_indptr'] = matrix.indptr
+            arrays[name + '_shape'] = numpy.array(matrix.shape)
+
+        numpy.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename, vocab, profile_cache_size=128):
+
+        '''
+        Return a Cooccurrences instance from a file written by `save`. The
+        original texts are not restored, so `texts` and `counts` only hold
+        texts added afterwards.
+        '''
+
+        arrays = numpy.load(filename)
+
+        matrices = {}
+        for name in ('C', 'count_matrix'):
+            matrices[name] = sparse.csr_matrix((arrays[name + '_data'],
+                                                arrays[name + '_indices'],
+                                                arrays[name + '_indptr']),
+                                               shape=tuple(arrays[name + '_shape']))
+
+        assert matrices['C'].shape == (len(vocab.word2index),) * 2
+
+        cooccurrences = cls.__new__(cls)
+        cooccurrences.filename = filename
+        cooccurrences.cache = os.path.dirname(filename)
+        cooccurrences.vocabulary = vocab
+        cooccurrences.initialized = False
+        cooccurrences.profile_cache = LRUCache(profile_cache_size)
+        cooccurrences.conditional_probabilities = None
+        cooccurrences.texts = []
+        cooccurrences.counts = []
+        cooccurrences.count_matrix = matrices['count_matrix']
+        cooccurrences.C = matrices['C']
+
+        return cooccurrences
+
+    def get_joint_probabilities(self):
+
+        '''
+        Return the VxV matrix of joint probabilities of pairs of words
+        cooccurring in a text.
+        '''
+
+        return get_joint_probabilities(self.count_matrix)
 
     def get_cooccurrence_profile(self, word):
 
         '''
         For a given word, return its coccurrence counts for every other word.
+        Recently requested profiles are kept in `profile_cache`, and a copy
+        is returned, so that callers may change it.
 
         '''
 
-        j = self.vocabulary.word2index[word]
+        profile = self.profile_cache.get(word)
 
-        return self.C[j].A[0] # The zero index returns a one-dim array
-    
+        if profile is None:
+
+            j = self.vocabulary.word2index[word]
+
+            profile = self.C[j].A[0] # The zero index returns a one-dim array
+            profile.flags.writeable = False
+
+            self.profile_cache.put(word, profile)
+
+        return profile.copy()
+
+    def get_cooccurrence_profiles(self, words, dense=False):
+
+        '''
+        For a list of words, return their coccurrence counts for every other
+        word, one row per word, as a sparse csr matrix or, if `dense`, an
+        array. The rows are taken from `C` in a single slicing operation.
+
+        '''
+
+        J = [self.vocabulary.word2index[word] for word in words]
+
+        profiles = sparse.csr_matrix(self.C)[J]
+
+        if dense:
+            return profiles.A
+        else:
+            return profiles
+
+    def get_texts_matrix(self, texts):
+
+        '''
+        Tokenize each of the `texts` and return the sparse matrix, with one
+        row per text and one column per vocabulary word, of its word counts.
+        Words not in the vocabulary are ignored.
+
+        '''
+
+        counts = []
+        for words in tokenize_many(texts):
+            text_counts = defaultdict(int)
+            for word in words:
+                text_counts[word] += 1
+            counts.append(text_counts)
+
+        return self.get_count_matrix(counts)
+
+    def get_text_predictions(self, texts, words, smooth=True):
+
+        '''
+        For each of the `texts`, return the predicted probability of each of
+        the `words`, as a texts by words float32 array. A text's prediction
+        is the average, over the tokens of the text, of the smoothed
+        conditional probability of the word given the token.
+
+        All texts are done together using sparse matrix products, and only
+        the columns of the queried words are calculated.
+
+        '''
+
+        if self.conditional_probabilities is None:
+
+            f = numpy.asarray(self.C.sum(0)).flatten()
+            f = f/f.sum()
+
+            self.conditional_probabilities\
+                = ConditionalProbabilities(self.C, self.vocabulary, f=f)
+
+        return self.conditional_probabilities.get_mixture_probabilities(
+            self.get_texts_matrix(texts), words, smooth=smooth)
 
     def get_sparse_matrix_ijv(self):
 
         C = sparse.coo_matrix(self.C)
 
         return (C.row, C.col, C.data) + C.shape
+
+
+def scale_rows(M, scale):
+
+    '''
+    Return a copy of the csr matrix `M` with row i multiplied by scale[i].
+    The nonzero values are scaled directly, with no diagonal matrix product.
+    '''
+
+    M = sparse.csr_matrix(M, dtype=numpy.float64, copy=True)
+    M.data *= numpy.repeat(scale, numpy.diff(M.indptr))
+
+    return M
+
+
+def normalize_rows(M):
+
+    '''
+    Return a copy of the sparse matrix `M` with each row divided by its sum.
+    Rows that sum to zero are left as zero.
+    '''
+
+    row_sums = numpy.asarray(M.sum(1)).flatten().astype(numpy.float64)
+
+    scale = numpy.zeros_like(row_sums)
+    scale[row_sums != 0] = 1/row_sums[row_sums != 0]
+
+    return scale_rows(M, scale)
+
+
+def get_joint_probabilities(R):
+
+    '''
+    For the JxV matrix `R` of word counts in texts, return the VxV matrix of
+    the probability of drawing a given pair of words, without replacement,
+    from a text chosen at random.
+    '''
+
+    R = sparse.csr_matrix(R, dtype=numpy.float64)
+
+    J, V = R.shape
+
+    Rj = numpy.asarray(R.sum(1)).flatten()
+
+    z = Rj * (Rj - 1)
+
+    scale = numpy.zeros_like(z)
+    scale[z != 0] = 1/z[z != 0]
+
+    S = scale_rows(R, scale)
+
+    P = S.T.dot(R).tocsr()
+    P.setdiag(P.diagonal() - numpy.asarray(S.sum(0)).flatten())
+
+    return P/J
+
+
+class ConditionalProbabilities(object):
+
+    '''
+    Smoothed conditional probabilities of words given cue words, from a VxV
+    matrix `M` of joint probabilities or cooccurrence counts.
+
+    The probability of word k given cue j is M[j,k]/sum(M[j]), except that,
+    when smoothing, where M[j,k] is zero the unigram frequency f[k] is used
+    instead and the result is renormalized. By default, f is the column sum
+    of `M`.
+
+    All lookups are done in batch and return float32 arrays. Their `smooth`
+    argument, if given, overrides the instance's default.
+    '''
+
+    def __init__(self, M, vocab, f=None, smooth=True):
+
+        M = sparse.csr_matrix(M, dtype=numpy.float64)
+        M.eliminate_zeros()
+
+        if f is None:
+            f = numpy.asarray(M.sum(0)).flatten()
+
+        self.vocabulary = vocab
+        self.smooth = smooth
+        self.f = numpy.asarray(f, dtype=numpy.float64)
+        self.conditional = normalize_rows(M)
+
+        # The normalizing constant of each smoothed row is the row's own
+        # mass, which is one unless the row is empty, plus the unigram
+        # frequencies of the words that never cooccur with the cue.
+        nonzero = self.conditional.copy()
+        nonzero.data[:] = 1.0
+
+        has_mass = numpy.diff(self.conditional.indptr) > 0
+
+        self.Z = has_mass + self.f.sum() - nonzero.dot(self.f)
+
+    def _get_indices(self, words):
+
+        return numpy.array([self.vocabulary.word2index[word] for word in words],
+                           dtype=numpy.int64)
+
+    def get_conditional_probabilities(self, cues, targets, smooth=None):
+
+        '''
+        Return the probability of targets[i] given cues[i], for all i.
+
+        '''
+
+        assert len(cues) == len(targets)
+
+        cue_indices = self._get_indices(cues)
+        target_indices = self._get_indices(targets)
+
+        if len(cue_indices) == 0:
+            return numpy.zeros(0, dtype=numpy.float32)
+
+        p = numpy.asarray(
+            self.conditional[cue_indices, target_indices]).flatten()
+
+        if smooth is None:
+            smooth = self.smooth
+
+        if smooth:
+            I = p == 0
+            p[I] = self.f[target_indices[I]]
+            p /= self.Z[cue_indices]
+
+        return p.astype(numpy.float32)
+
+    def get_mixture_probabilities(self, W, targets, smooth=None):
+
+        '''
+        For the NxV sparse matrix `W` of (unnormalized) weights over cue
+        words, return the NxT matrix whose row n is the probability of each
+        of the T `targets` averaged over the cues, weighted by W[n].
+
+        '''
+
+        target_indices = self._get_indices(targets)
+
+        W = normalize_rows(W)
+
+        conditional = self.conditional[:, target_indices].tocsr()
+
+        if smooth is None:
+            smooth = self.smooth
+
+        if smooth:
+
+            # Divide each cue's weight by its normalizing constant.
+            W.data /= self.Z[W.indices]
+
+            nonzero = conditional.copy()
+            nonzero.data[:] = 1.0
+
+            f = self.f[target_indices]
+
+            p = W.dot(conditional).A\
+                + numpy.outer(W.sum(1).A.flatten(), f)\
+                - W.dot(nonzero).A * f
+
+        else:
+
+            p = W.dot(conditional).A
+
+        return p.astype(numpy.float32)
+
+    def get_predictions(self, cue_lists, targets, smooth=None):
+
+        '''
+        For each list of cue words in `cue_lists`, return the probability of
+        each of the `targets`, averaged over the list's cues.
+
+        '''
+
+        rows = []
+        cols = []
+        for i, cues in enumerate(cue_lists):
+            rows.extend([i] * len(cues))
+            cols.extend(self._get_indices(cues))
+
+        W = sparse.csr_matrix((numpy.ones(len(rows)), (rows, cols)),
+                              shape=(len(cue_lists), len(self.f)))
+
+        return self.get_mixture_probabilities(W, targets, smooth=smooth)
+
+
+def get_ppmi(C):
+
+    '''
+    Return the positive pointwise mutual information transform of the
+    sparse VxV cooccurrence count matrix `C`, as a csr matrix.
+    '''
+
+    C = sparse.csr_matrix(C, dtype=numpy.float64)
+    C.eliminate_zeros()
+
+    total = C.sum()
+    row_sums = numpy.asarray(C.sum(1)).flatten()
+    col_sums = numpy.asarray(C.sum(0)).flatten()
+
+    rows = numpy.repeat(numpy.arange(C.shape[0]), numpy.diff(C.indptr))
+
+    pmi = numpy.log(C.data * total / (row_sums[rows] * col_sums[C.indices]))
+
+    M = sparse.csr_matrix((numpy.maximum(pmi, 0), C.indices, C.indptr),
+                          shape=C.shape)
+    M.eliminate_zeros()
+
+    return M
+
+
+class EmbeddingIndex(object):
+
+    '''
+    Low rank word embeddings, obtained by a randomized truncated SVD of the
+    PPMI transform of a cooccurrence matrix, for fast nearest neighbour
+    queries. The float32 embeddings are unit length, so that their dot
+    products are cosine similarities, and can be saved and then loaded
+    memory-mapped.
+
+    Building the index needs scikit-learn.
+    '''
+
+    def __init__(self, embeddings, vocab):
+
+        assert len(embeddings) == len(vocab.word2index)
+
+        self.embeddings = embeddings
+        self.vocabulary = vocab
+
+    @classmethod
+    def new(cls, C, vocab, dimensions=300, iterations=5, seed=None):
+
+        '''
+        Build the index from the sparse VxV cooccurrence matrix `C`, e.g.
+        `Cooccurrences.C`.
+        '''
+
+        from sklearn.utils.extmath import randomized_svd
+
+        U, S, _ = randomized_svd(get_ppmi(C),
+                                 n_components=dimensions,
+                                 n_iter=iterations,
+                                 random_state=seed)
+
+        embeddings = U * numpy.sqrt(S)
+
+        norms = numpy.sqrt((embeddings**2).sum(1))
+        norms[norms == 0] = 1.0
+
+        return cls((embeddings.T/norms).T.astype(numpy.float32), vocab)
+
+    def save(self, filename):
+
+        '''
+        Save the embeddings to the npy file `filename`.
+        '''
+
+        numpy.save(filename, self.embeddings)
+
+    @classmethod
+    def load(cls, filename, vocab, mmap_mode='r'):
+
+        '''
+        Load the embeddings saved in the npy file `filename`, memory-mapped
+        by default.
+        '''
+
+        return cls(numpy.load(filename, mmap_mode=mmap_mode), vocab)
+
+    def get_nearest_neighbours(self, words, k=10, batch_size=1024):
+
+        '''
+        For each of the `words`, return the indices of its `k` most similar
+        words, excluding itself, and their cosine similarities. Both are
+        arrays with one row per word, in decreasing order of similarity.
+
+        '''
+
+        J = numpy.array([self.vocabulary.word2index[word] for word in words],
+                        dtype=numpy.int64)
+
+        V = len(self.embeddings)
+        k = min(k, V - 1)
+
+        indices = numpy.zeros((len(J), k), dtype=numpy.int64)
+        similarities = numpy.zeros((len(J), k), dtype=numpy.float32)
+
+        for start in xrange(0, len(J), batch_size):
+
+            batch = J[start:start+batch_size]
+            n = len(batch)
+
+            scores = numpy.dot(self.embeddings[batch], self.embeddings.T)
+            scores[numpy.arange(n), batch] = -numpy.inf
+
+            top_k = numpy.argpartition(-scores, k-1, axis=1)[:, :k]
+            top_k_scores = scores[numpy.arange(n)[:, None], top_k]
+
+            order = numpy.argsort(-top_k_scores, axis=1)
+            rows = numpy.arange(n)[:, None]
+
+            indices[start:start+n] = top_k[rows, order]
+            similarities[start:start+n] = top_k_scores[rows, order]
+
+        return indices, similarities
+
+    def get_associates(self, words, k=10, batch_size=1024):
+
+        '''
+        For each of the `words`, return the list of its `k` most similar
+        words.
+
+        '''
+
+        indices, _ = self.get_nearest_neighbours(words, k=k,
+                                                 batch_size=batch_size)
+
+        return [[self.vocabulary.index2word[i] for i in row] for row in indices]
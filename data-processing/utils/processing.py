@@ -8,15 +8,24 @@ a wilhelm based online experiment server.
 
 import shutil
 import json
+import hashlib
+import itertools
+import multiprocessing
 import tarfile
 import tempfile
 import urllib
 import os
-import pandas
 
 import random
+from collections import OrderedDict, deque
 
-fake_subject_uids = [] # Override this at run time using get_fake_subject_uids
+from .utils import lazy_import
+
+numpy = lazy_import('numpy')
+pandas = lazy_import('pandas')
+urllib2 = lazy_import('urllib2')
+
+fake_subject_uids = set() # Override this at run time using get_fake_subject_uids
 
 def get_data(url, rmdir=True):
 
@@ -42,10 +51,209 @@ def get_data(url, rmdir=True):
     return data
 
 
+class _JSONStream(object):
+
+    """
+    Read a json document from a file object a value at a time, so that the
+    items of large arrays can be parsed one by one. Each value is parsed by
+    json's raw_decode from a buffer that is refilled as needed.
+
+    """
+
+    def __init__(self, f, chunk_size=1 << 16):
+
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size=None):
+
+        if self.position:
+            self.buffer = self.buffer[self.position:]
+            self.position = 0
+
+        chunk = self.f.read(size or self.chunk_size)
+        if chunk:
+            self.buffer += chunk
+        else:
+            self.eof = True
+
+        return bool(chunk)
+
+    def peek(self):
+
+        """
+        Return the next character that is not whitespace, without consuming it.
+
+        """
+
+        while True:
+
+            while (self.position < len(self.buffer)
+                   and self.buffer[self.position] in ' \t\n\r'):
+                self.position += 1
+
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+
+            if not self._fill():
+                raise ValueError('Unexpected end of json data.')
+
+    def expect(self, character):
+
+        if self.peek() != character:
+            raise ValueError('Expecting %r in json data, got %r.'
+                             % (character, self.buffer[self.position]))
+
+        self.position += 1
+
+    def read_value(self):
+
+        self.peek()
+
+        size = self.chunk_size
+        while True:
+
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                if self.eof:
+                    raise
+                value, end = None, len(self.buffer)
+
+            # A value that reaches the end of the buffer may be incomplete.
+            if end < len(self.buffer) or self.eof:
+                self.position = end
+                return value
+
+            self._fill(size)
+            size *= 2
+
+    def iter_array(self):
+
+        """
+        Yield the index of each item of an array, with the stream at the
+        start of the item, which must be read before the next.
+
+        """
+
+        self.expect('[')
+
+        if self.peek() == ']':
+            self.position += 1
+            return
+
+        index = 0
+        while True:
+
+            yield index
+            index += 1
+
+            if self.peek() == ',':
+                self.position += 1
+            else:
+                self.expect(']')
+                return
+
+    def iter_object(self):
+
+        """
+        Yield the key of each member of an object, with the stream at the
+        start of the value, which must be read before the next.
+
+        """
+
+        self.expect('{')
+
+        if self.peek() == '}':
+            self.position += 1
+            return
+
+        while True:
+
+            key = self.read_value()
+            self.expect(':')
+
+            yield key
+
+            if self.peek() == ',':
+                self.position += 1
+            else:
+                self.expect('}')
+                return
+
+
+def _open_data_archive(source):
+
+    if os.path.exists(source):
+        return open(source, 'rb')
+    else:
+        return urllib2.urlopen(source)
+
+
+def iter_sessions(source, experiment_version=None):
+
+    """
+    Yield the sessions of a wilhelm experiment data archive, one at a time,
+    from a local file or a url. The archive is read as a stream, and only its
+    data.json member is parsed, a session at a time, so nothing is written
+    to disk and the whole json is never held in memory.
+
+    If `experiment_version` is given, only the sessions of that experiment
+    version, as an index of ExperimentVersions, are yielded, so that
+
+        list(iter_sessions(url, 0)) == get_data(url)['ExperimentVersions'][0]['Sessions']
+
+    """
+
+    f = _open_data_archive(source)
+
+    try:
+
+        tar = tarfile.open(fileobj=f, mode='r|bz2')
+
+        for member in tar:
+
+            if os.path.basename(member.name) != 'data.json':
+                continue
+
+            stream = _JSONStream(tar.extractfile(member))
+
+            for key in stream.iter_object():
+
+                if key != 'ExperimentVersions':
+                    stream.read_value()
+                    continue
+
+                for index in stream.iter_array():
+
+                    if experiment_version is not None and index != experiment_version:
+                        stream.read_value()
+                        continue
+
+                    for version_key in stream.iter_object():
+
+                        if version_key == 'Sessions':
+                            for _ in stream.iter_array():
+                                yield stream.read_value()
+                        else:
+                            stream.read_value()
+
+            return
+
+        raise ValueError('No data.json in %s.' % source)
+
+    finally:
+        f.close()
+
+
 def get_fake_subject_uids(fake_subject_list_filename):
 
-    return [uid[:7] for uid in 
-            open(fake_subject_list_filename).read().strip().split()]
+    return set([uid[:7] for uid in 
+                open(fake_subject_list_filename).read().strip().split()])
 
 
 class FakeSubjectException(Exception):
@@ -110,10 +318,18 @@ def parse_session(session):
         
         return []
 
-def get_tmp_uid(k=7):
+def get_tmp_uid(k=7, random_state=random):
     ''' Generate a k hex digit unique identifier.'''
     uidformat = '%%0%dx' % k
-    return uidformat % random.getrandbits(k*4) # Each hex digit is 2^4 bits.
+    return uidformat % random_state.getrandbits(k*4) # Each hex digit is 2^4 bits.
+
+def get_slide_uid(seed, session_id, slide_index, k=7):
+    ''' 
+    Generate a k hex digit identifier for a slide that depends only on the
+    seed, the session ID, and the slide's index in the session.
+    '''
+    h = hashlib.sha256('%s:%s:%d' % (seed, session_id, slide_index))
+    return h.hexdigest()[:k]
 
 def parse_textrecognition_slides(slides):
     if slides[0]['Name']:
@@ -154,7 +370,7 @@ widget_parsers_map = dict(TextDisplay = parse_textdisplay_information,
                           WordRecallTest = parse_word_recall_test_information)
 
 
-def parse_textrecognitiontest_information(slide_information):
+def parse_textrecognitiontest_information(slide_information, tmp_uid=None):
     
     data_dict = {}
     
@@ -165,7 +381,8 @@ def parse_textrecognitiontest_information(slide_information):
             data_dict[widget_name] = widget_parsers_map[widget_name](widget)
 
     slide_info = parse_slide_information(slide_information)
-    tmp_uid = get_tmp_uid()
+    if tmp_uid is None:
+        tmp_uid = get_tmp_uid()
     text_data = data_dict['TextDisplay']
     all_data = []
     for trial_data in data_dict['WordRecognitionTest']:
@@ -174,7 +391,7 @@ def parse_textrecognitiontest_information(slide_information):
     return all_data
 
 
-def parse_textrecalltest_information(slide_information):
+def parse_textrecalltest_information(slide_information, tmp_uid=None):
     
     data_dict = {}
     
@@ -185,7 +402,8 @@ def parse_textrecalltest_information(slide_information):
             data_dict[widget_name] = widget_parsers_map[widget_name](widget)
 
     slide_info = parse_slide_information(slide_information)
-    tmp_uid = get_tmp_uid()
+    if tmp_uid is None:
+        tmp_uid = get_tmp_uid()
     text_data = data_dict['TextDisplay']
     all_data = []
     for trial_data in data_dict['WordRecallTest']:
@@ -234,64 +452,307 @@ def parse_textrecognition_session(session):
     else:
         return []
 
-def get_textrecall_data(sessions, seed=None):
+session_headers = ['session', 
+                   'subject', 
+                   'age', 
+                   'sex']
 
-    if seed:
-        random.seed(seed)
+slide_headers = ['slide', 
+                 'completed', 
+                 'text', 
+                 'readingtime']
 
-    data = []
-    for session in sessions:
-        _data = parse_textrecall_session(session)
-        if _data:
-            data.extend(_data)
+textrecall_headers = session_headers + slide_headers + ['word']
+
+textrecognition_headers = session_headers + slide_headers + ['word', 
+                                                             'expected',
+                                                             'order',
+                                                             'hit',
+                                                             'response',
+                                                             'correct',
+                                                             'rt']
+
+categorical_headers = ('session', 'subject', 'text', 'word')
+boolean_headers = ('hit', 'correct')
+float_headers = ('rt',)
+
+class TrialTable(object):
+
+    """
+    A table of trials that is built a row at a time into a list per column,
+    and then made into a data frame.
+
+    In a typed data frame, the session, subject, text and word columns are
+    categorical, the hit and correct columns are boolean unless they have
+    missing values, and rt is float. Otherwise, the column types are as
+    pandas infers them from the rows.
+
+    """
+
+    def __init__(self, headers):
+
+        self.headers = list(headers)
+        self.columns = [[] for _ in self.headers]
+
+    def __len__(self):
+
+        return len(self.columns[0])
+
+    def append(self, row):
+
+        for column, value in zip(self.columns, row):
+            column.append(value)
 
-    Df = pandas.DataFrame(data)
+    def extend(self, rows):
 
-    headers = ['session', 
-               'subject', 
-               'age', 
-               'sex', 
-               'slide', 
-               'completed', 
-               'text', 
-               'readingtime', 
-               'word']
+        for row in rows:
+            self.append(row)
 
-    Df.columns = headers
+    def _get_typed_column(self, header, values):
 
+        if header in categorical_headers:
+            return pandas.Categorical(values)
+        elif header in boolean_headers and None not in values:
+            return numpy.array(values, dtype=bool)
+        elif header in float_headers:
+            return numpy.array(values, dtype=float)
+        else:
+            return values
+
+    def get_dataframe(self, typed=False):
+
+        if not typed:
+            return pandas.DataFrame(zip(*self.columns) if len(self) else [], 
+                                    columns=self.headers)
+
+        return pandas.DataFrame(OrderedDict((header, self._get_typed_column(header, values))
+                                            for header, values in zip(self.headers,
+                                                                      self.columns)),
+                                columns=self.headers)
+
+
+def add_item_keys(Df, column='stimulus'):
+
+    """
+    Add the text-word item keys, like '42-word', as `column`. This is
+    the vectorized version of
+
+        Df[column] = Df[['text', 'word']].apply(lambda x: str(x[0]) + '-' + x[1], axis=1)
+
+    and the keys are only made once for each text and word pair. The new
+    column is categorical if the text column is.
+
+    """
+
+    text = pandas.Categorical(Df['text'])
+    word = pandas.Categorical(Df['word'])
+
+    assert (text.codes >= 0).all() and (word.codes >= 0).all(), 'Missing text or word.'
+
+    pairs = text.codes.astype(numpy.int64) * len(word.categories) + word.codes
+
+    unique_pairs, inverse = numpy.unique(pairs, return_inverse=True)
+
+    keys = numpy.empty(len(unique_pairs), dtype=object)
+    keys[:] = [str(text.categories[pair // len(word.categories)]) + '-'\
+               + word.categories[pair % len(word.categories)]
+               for pair in unique_pairs]
+
+    if pandas.api.types.is_categorical_dtype(Df['text']):
+        Df[column] = pandas.Categorical(keys[inverse])
+    else:
+        Df[column] = keys[inverse]
 
     return Df
+
+def get_textrecall_data(sessions, seed=None, typed=False):
+
+    if seed:
+        random.seed(seed)
+
+    table = TrialTable(textrecall_headers)
+    for session in sessions:
+        table.extend(parse_textrecall_session(session))
+
+    return table.get_dataframe(typed=typed)
  
-def get_textrecognition_data(sessions, seed=None):
+def get_textrecognition_data(sessions, seed=None, typed=False):
 
     if seed:
         random.seed(seed)
 
-    data = []
+    table = TrialTable(textrecognition_headers)
     for session in sessions:
-        _data = parse_textrecognition_session(session)
-        if _data:
-            data.extend(_data)
-    Df = pandas.DataFrame(data)
-
-    headers = ['session', 
-               'subject', 
-               'age', 
-               'sex', 
-               'slide', 
-               'completed', 
-               'text', 
-               'readingtime', 
-               'word', 
-               'expected',
-               'order',
-               'hit',
-               'response',
-               'correct',
-               'rt']
-
-    Df.columns = headers
+        table.extend(parse_textrecognition_session(session))
 
-    return Df
+    return table.get_dataframe(typed=typed)
+
+def get_textrecall_and_recognition_data(sessions, 
+                                        recall_seed=None, 
+                                        recognition_seed=None,
+                                        typed=False):
+
+    """
+    Return the text recall and text recognition data frames of
+    get_textrecall_data and get_textrecognition_data in one pass over the
+    sessions, parsing each session and slide once.
+
+    The slide ids of each are drawn from their own random number generator,
+    seeded with `recall_seed` and `recognition_seed`, and so are the same as
+    those from the two functions with the same seeds.
+
+    """
+
+    recall_random = random.Random(recall_seed) if recall_seed else random
+    recognition_random = random.Random(recognition_seed) if recognition_seed else random
+
+    recall_table = TrialTable(textrecall_headers)
+    recognition_table = TrialTable(textrecognition_headers)
+
+    for session in sessions:
+
+        session_info = parse_session(session)
+
+        for slide in session['Playlist information']['Slides']:
+
+            if slide['Name'] == 'TextRecallMemoryTest':
+
+                trials = parse_textrecalltest_information(
+                    slide, tmp_uid=get_tmp_uid(random_state=recall_random))
+
+                if session_info:
+                    recall_table.extend([session_info + trial for trial in trials])
+
+            elif slide['Name'] == 'TextRecognitionMemoryTest':
+
+                trials = parse_textrecognitiontest_information(
+                    slide, tmp_uid=get_tmp_uid(random_state=recognition_random))
+
+                if session_info:
+                    recognition_table.extend([session_info + trial for trial in trials])
+
+    return (recall_table.get_dataframe(typed=typed),
+            recognition_table.get_dataframe(typed=typed))
+
+def _initialize_session_parsing_worker(_fake_subject_uids):
+
+    global fake_subject_uids
+    fake_subject_uids = _fake_subject_uids
+
+def _parse_recall_and_recognition_session(seed_session):
+
+    seed, session = seed_session
+
+    session_info = parse_session(session)
+
+    recall_data = []
+    recognition_data = []
+
+    if not session_info:
+        return recall_data, recognition_data
+
+    session_id = session['Experiment session']['Session ID']
+
+    for slide_index, slide in enumerate(session['Playlist information']['Slides']):
+
+        if slide['Name'] == 'TextRecallMemoryTest':
+
+            trials = parse_textrecalltest_information(
+                slide, tmp_uid=get_slide_uid(seed, session_id, slide_index))
+            recall_data.extend([session_info + trial for trial in trials])
+
+        elif slide['Name'] == 'TextRecognitionMemoryTest':
+
+            trials = parse_textrecognitiontest_information(
+                slide, tmp_uid=get_slide_uid(seed, session_id, slide_index))
+            recognition_data.extend([session_info + trial for trial in trials])
+
+    return recall_data, recognition_data
+
+def _parse_recall_and_recognition_sessions(seed_sessions):
+
+    seed, sessions = seed_sessions
+
+    return [_parse_recall_and_recognition_session((seed, session))
+            for session in sessions]
+
+def _iter_parsed_sessions(sessions, seed, processes, chunksize):
+
+    """
+    Yield, in order, the recall and recognition data of each session, parsed
+    by a pool of `processes` processes in chunks of `chunksize` sessions.
+    At most two chunks per process are read ahead of the results, so only
+    those sessions are held in memory.
+
+    """
+
+    processes = processes or multiprocessing.cpu_count()
+
+    chunks = iter(lambda: list(itertools.islice(sessions, chunksize)), [])
+
+    pool = multiprocessing.Pool(processes,
+                                initializer=_initialize_session_parsing_worker,
+                                initargs=(fake_subject_uids,))
+
+    try:
+
+        pending = deque()
+        for chunk in chunks:
+
+            pending.append(pool.apply_async(_parse_recall_and_recognition_sessions,
+                                            ((seed, chunk),)))
+
+            if len(pending) >= 2 * processes:
+                for result in pending.popleft().get():
+                    yield result
+
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+
+        pool.close()
+
+    except:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
+
+def get_textrecall_and_recognition_data_parallel(sessions, 
+                                                 seed=None, 
+                                                 processes=None, 
+                                                 chunksize=16,
+                                                 typed=False):
+
+    """
+    Like get_textrecall_and_recognition_data, but parse the sessions with a
+    pool of `processes` processes. Each slide id is derived from the seed,
+    the session ID and the slide's index by get_slide_uid, rather than drawn
+    at random, so the data frames are the same for any number of processes.
+
+    `sessions` can be any iterable, such as iter_sessions. It is read in
+    chunks of `chunksize` sessions, and at most two chunks per process are
+    read ahead of the parsing.
+
+    """
+
+    recall_table = TrialTable(textrecall_headers)
+    recognition_table = TrialTable(textrecognition_headers)
+
+    sessions = iter(sessions)
+
+    if processes == 1:
+        results = itertools.imap(_parse_recall_and_recognition_session, 
+                                 ((seed, session) for session in sessions))
+    else:
+        results = _iter_parsed_sessions(sessions, seed, processes, chunksize)
+
+    for recall_data, recognition_data in results:
+        recall_table.extend(recall_data)
+        recognition_table.extend(recognition_data)
+
+    return (recall_table.get_dataframe(typed=typed),
+            recognition_table.get_dataframe(typed=typed))
 
 data2csv = lambda data: '\n'.join([','.join(map(str, datum)) for datum in data])
@@ -7,16 +7,56 @@ National Corpus.
 # Standard library imports
 #=============================================================================
 import os
+import bz2
+import zipfile
 import itertools
+import json
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
 import cPickle as pickle
+import xml.etree.cElementTree as ElementTree
+from multiprocessing.pool import ThreadPool
 
-from bs4 import BeautifulSoup
+import numpy
+
+from . import utils
+from .vocabulary import Vocab as _Vocab
 
 #================================ End Imports ================================
 
 vocabulary_directory='vocab'
 stopwords_lists_filenames = ('FoxStoplist.txt', 'SmartStoplist.txt')
 vocabulary_filenames = ('2of4brif.txt',)
+text_type_signatures = ('<wtext', '<stext')
+corpus_manifest_filename = '.corpus_manifest.json'
+
+
+def get_text_type(xmlfilename, chunk_size=65536):
+
+    """
+    Return the signature, "<wtext" or "<stext", of the text in the BNC xml
+    file, or None if it has neither. The file is read from its start only as
+    far as the signature.
+
+    """
+
+    overlap = max(map(len, text_type_signatures)) - 1
+
+    with open(xmlfilename) as f:
+        tail = ''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return None
+
+            contents = tail + chunk
+            for signature in text_type_signatures:
+                if signature in contents:
+                    return signature
+
+            tail = contents[-overlap:]
 
 
 class Corpus(object):
@@ -28,36 +68,141 @@ class Corpus(object):
         return corpus.corpus_filenames
 
 
-    def __init__(self, corpus_xmlfiles_rootdir):
+    def __init__(self, corpus_xmlfiles_rootdir, manifest_filename=None,
+                 threads=8):
+
+        """
+        The manifest of the corpus files is kept in `manifest_filename`, by
+        default a file in the corpus root directory. If it cannot be written
+        there, it is only kept in memory.
+
+        """
 
         self.corpus_xmlfiles_rootdir = corpus_xmlfiles_rootdir
 
+        if manifest_filename is None:
+            manifest_filename = os.path.join(corpus_xmlfiles_rootdir,
+                                             corpus_manifest_filename)
+
+        self.manifest_filename = manifest_filename
+        self.threads = threads
+
+        self._corpus_filenames = None
+        self._manifest = None
+
 
     @property
     def corpus_filenames(self):
 
         """
-        Get the list of all BNC xml corpus files. 
+        Get the list of all BNC xml corpus files. The directory tree is
+        walked only the first time.
 
         """
 
-        corpus_xmlfiles = []
+        if self._corpus_filenames is None:
+
+            corpus_xmlfiles = []
+
+            for root, dirs, filenames in os.walk(self.corpus_xmlfiles_rootdir):
+                for filename in filenames:
+                    basename, extension = os.path.splitext(filename)
+                    if extension == '.xml':
+                        corpus_xmlfiles.append(os.path.join(root, filename))
+
+            self._corpus_filenames = corpus_xmlfiles
+
+        return list(self._corpus_filenames)
+
+
+    def _read_manifest(self):
+
+        try:
+            with open(self.manifest_filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+    def _write_manifest(self, manifest):
+
+        fd, tmp_filename\
+            = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.manifest_filename)))
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f)
+
+            utils.set_default_permissions(tmp_filename)
+            os.rename(tmp_filename, self.manifest_filename)
+
+        except:
+            os.remove(tmp_filename)
+            raise
+
+
+    def get_manifest(self):
+
+        """
+        Return a dictionary giving the size, mtime and text type signature of
+        each corpus file.
+
+        The manifest is persisted. Only files that are new or whose size or
+        mtime has changed since it was written have their text type found
+        again, in parallel.
+
+        """
+
+        if self._manifest is None:
+
+            persisted_manifest = self._read_manifest()
+
+            manifest = {}
+            changed_filenames = []
+            for filename in self.corpus_filenames:
 
-        for root, dirs, filenames in os.walk(self.corpus_xmlfiles_rootdir):
-            for filename in filenames:
-                basename, extension = os.path.splitext(filename)
-                if extension == '.xml':
-                    corpus_xmlfiles.append(os.path.join(root, filename))
+                stat = os.stat(filename)
+                entry = persisted_manifest.get(filename)
 
+                if entry is None\
+                        or entry['size'] != stat.st_size\
+                        or entry['mtime'] != stat.st_mtime:
 
-        return corpus_xmlfiles
+                    entry = dict(size=stat.st_size,
+                                 mtime=stat.st_mtime,
+                                 text_type=None)
+
+                    changed_filenames.append(filename)
+
+                manifest[filename] = entry
+
+            if changed_filenames:
+
+                pool = ThreadPool(self.threads)
+                text_types = pool.map(get_text_type, changed_filenames)
+                pool.close()
+                pool.join()
+
+                for filename, text_type in zip(changed_filenames, text_types):
+                    manifest[filename]['text_type'] = text_type
+
+            if manifest != persisted_manifest:
+                try:
+                    self._write_manifest(manifest)
+                except (IOError, OSError):
+                    pass # E.g. a read-only corpus. Keep it in memory only.
+
+            self._manifest = manifest
+
+        return self._manifest
 
 
     def _get_written_or_spoken_corpus_filenames(self, signature):
 
+        manifest = self.get_manifest()
 
-        return [filename for filename in self.corpus_filenames 
-                if signature in open(filename).read()]
+        return [filename for filename in self.corpus_filenames
+                if manifest[filename]['text_type'] == signature]
 
 
     def get_written_corpus_filenames(self):
@@ -100,38 +245,98 @@ def get_corpus_file_soup(corpus_filename):
 
     """
 
+    from bs4 import BeautifulSoup
+
     return BeautifulSoup(open(corpus_filename), 'xml')
 
 
-def get_all_paragraphs(xmlfilename):
+def _get_tag_name(xmlelement):
 
     """
-    Return all paragraphs, indicating xml filename and div1 count and paragraph
-    count in the div1.
+    Return the tag name of the xmlelement without any namespace.
+
+    """
+
+    return xmlelement.tag.rsplit('}', 1)[-1]
+
+
+def iter_all_paragraphs(xmlfilename):
+
+    """
+    Yield all paragraphs, indicating xml filename and div1 count and paragraph
+    count in the div1, as get_all_paragraphs does.
+
+    The xml file is parsed incrementally and elements are cleared as soon as
+    they have been read, so only the paragraphs of the current div1 are held
+    in memory.
 
     """
 
-    soup = get_corpus_file_soup(xmlfilename)
+    div1_index = -1
+    div1_depth = 0 # Nesting depth of divs in the current div1. Zero if outside.
+    paragraphs = [] # Word lists of all paragraphs in the current div1.
+    open_paragraphs = [] # Word lists of the paragraphs now being read.
 
-    results = []
-    for i, div in enumerate(soup.find_all('div', {'level': '1'})):
+    for event, element in ElementTree.iterparse(xmlfilename,
+                                                events=('start', 'end')):
 
-        all_paragraphs_in_div1 = div.find_all('p')
+        tag = _get_tag_name(element)
 
-        for j, paragraph in enumerate(all_paragraphs_in_div1):
+        if event == 'start':
 
-            words = get_words(paragraph)
+            if tag == 'div':
+                if div1_depth:
+                    div1_depth += 1
+                elif element.get('level') == '1':
+                    div1_depth = 1
+                    div1_index += 1
 
-            paragraph_details = dict(corpus_filename = xmlfilename,
-                                     div1_index = i,
-                                     paragraph_index = j,
-                                     paragraph_count = len(all_paragraphs_in_div1),
-                                     words = words,
-                                     word_count = len(words))
+            elif tag == 'p' and div1_depth:
+                words = []
+                paragraphs.append(words)
+                open_paragraphs.append(words)
 
-            results.append(paragraph_details)
+        elif tag == 'w':
 
-    return results
+            if open_paragraphs:
+                word = ''.join(element.itertext()).strip().lower()
+                for words in open_paragraphs:
+                    words.append(word)
+
+            element.clear()
+
+        elif tag == 'p' and open_paragraphs:
+
+            open_paragraphs.pop()
+            element.clear()
+
+        elif tag == 'div' and div1_depth:
+
+            div1_depth -= 1
+
+            if div1_depth == 0:
+
+                for j, words in enumerate(paragraphs):
+                    yield dict(corpus_filename = xmlfilename,
+                               div1_index = div1_index,
+                               paragraph_index = j,
+                               paragraph_count = len(paragraphs),
+                               words = words,
+                               word_count = len(words))
+
+                paragraphs = []
+                element.clear()
+
+
+def get_all_paragraphs(xmlfilename):
+
+    """
+    Return all paragraphs, indicating xml filename and div1 count and paragraph
+    count in the div1.
+
+    """
+
+    return list(iter_all_paragraphs(xmlfilename))
 
 
 def get_all_paragraphs_parallel(view, xmlfilenames):
@@ -142,32 +347,157 @@ def get_all_paragraphs_parallel(view, xmlfilenames):
     return list(itertools.chain(*_all_paragraphs))
 
 
-def _read_wordlist(filename):
+def get_shard_filename(xmlfilename, shard_directory):
+
+    """
+    Return the name of the file in `shard_directory` in which the paragraphs
+    of the xml file are stored.
+
+    """
+
+    basename, _ = os.path.splitext(os.path.basename(xmlfilename))
+    path_hash = hashlib.sha1(os.path.abspath(xmlfilename)).hexdigest()[:8]
+
+    return os.path.join(shard_directory, '%s_%s.pkl' % (basename, path_hash))
+
+
+def _dump_all_paragraphs(xmlfilename_and_shard_filename):
+
+    """
+    Write all paragraphs of an xml file to its shard. The shard is written
+    to a temporary file first, so it only exists once it is complete.
+
+    """
+
+    xmlfilename, shard_filename = xmlfilename_and_shard_filename
+
+    tmp_filename = '%s.%d.tmp' % (shard_filename, os.getpid())
+    dump(list(iter_all_paragraphs(xmlfilename)), tmp_filename)
+    os.rename(tmp_filename, shard_filename)
+
+    return shard_filename
+
+
+def get_all_paragraphs_sharded(xmlfilenames, shard_directory, processes=None,
+                               verbose=False):
+
+    """
+    Extract all paragraphs of the xml files using a local pool of `processes`
+    processes, by default one per cpu. Each file's paragraphs are written to
+    its own shard in `shard_directory` as soon as its worker finishes, in
+    whatever order that is. Files whose shards already exist are skipped, so
+    an interrupted extraction can be resumed.
+
+    Return the list of shard filenames, in the order of `xmlfilenames`. Read
+    them with `load` or `iter_shards`.
+
+    """
+
+    utils.mkdir_p(shard_directory)
+
+    shard_filenames = [get_shard_filename(xmlfilename, shard_directory)
+                       for xmlfilename in xmlfilenames]
+
+    remaining = [(xmlfilename, shard_filename)
+                 for xmlfilename, shard_filename in zip(xmlfilenames,
+                                                        shard_filenames)
+                 if not os.path.exists(shard_filename)]
+
+    if verbose:
+        print('%d of %d shards already exist.' % (len(shard_filenames) - len(remaining),
+                                                  len(shard_filenames)))
+
+    if remaining:
+
+        pool = multiprocessing.Pool(processes)
+
+        try:
+            for i, shard_filename in enumerate(
+                    pool.imap_unordered(_dump_all_paragraphs, remaining), 1):
+
+                if verbose:
+                    print('%d/%d: %s' % (i, len(remaining), shard_filename))
+
+            pool.close()
+
+        except:
+            pool.terminate()
+            raise
+
+        finally:
+            pool.join()
+
+    return shard_filenames
+
+
+def iter_shards(shard_filenames):
+
+    """
+    Yield the paragraphs stored in each shard, one shard in memory at a time.
+
+    """
+
+    for shard_filename in shard_filenames:
+        for paragraph_details in iterload(shard_filename):
+            yield paragraph_details
+
+
+def _read_wordlist(filename, directory=None):
     
     """
     Read in file contents, return all newline delimited strings
-    unless the line starts with "#".
+    unless the line starts with "#". The file is in `directory`, by
+    default the vocabulary directory.
     
     """
 
-    filepath = os.path.join(vocabulary_directory, filename)
+    if directory is None:
+        directory = vocabulary_directory
+
+    filepath = os.path.join(directory, filename)
     
     file_contents = open(filepath).read().strip().split('\n')
     return [word for word in file_contents if word[0] != '#']
 
 
+_wordlists_cache = {}
+
+def clear_wordlists_cache():
+
+    """
+    Forget the words lists read by _get_wordlists_from_filenames.
+
+    """
+
+    _wordlists_cache.clear()
+
+
 def _get_wordlists_from_filenames(words_list_filenames):
 
     """
     Read in all words lists. Create their set union.
     Return as new list.
 
+    The files are only read again when their size or modification time
+    changes, or after clear_wordlists_cache.
+
     """
 
-    words_sets = map(lambda arg: set(_read_wordlist(arg)), 
-                     words_list_filenames)
+    key = (vocabulary_directory, tuple(words_list_filenames))
+
+    stats = []
+    for filename in words_list_filenames:
+        stat = os.stat(os.path.join(vocabulary_directory, filename))
+        stats.append((stat.st_size, stat.st_mtime))
+
+    if key not in _wordlists_cache or _wordlists_cache[key][0] != stats:
+
+        words_sets = map(lambda arg: set(_read_wordlist(arg)), 
+                         words_list_filenames)
+
+        _wordlists_cache[key] = (stats, list(set.union(*words_sets)))
 
-    return list(set.union(*words_sets))
+    return list(_wordlists_cache[key][1])
 
 
 def get_stopwords_list():
@@ -192,7 +522,7 @@ def get_brief_vocabulary():
     return _get_wordlists_from_filenames(vocabulary_filenames)
 
 
-class Vocab(object):
+class Vocab(_Vocab):
 
     def __init__(self, vocab=None, stopwords=None):
 
@@ -211,20 +541,7 @@ class Vocab(object):
         else:
             _vocab = set(vocab)
 
-        vocab = sorted(_vocab.difference(_stopwords))
-
-        word2index = {word:i for i, word in enumerate(vocab)}
-        index2word = {i:word for i, word in enumerate(vocab)}
-
-        for key in word2index:
-            assert index2word[word2index[key]] == key
-
-        for key in index2word:
-            assert word2index[index2word[key]] == key
-
-        self.vocab = vocab
-        self.word2index = word2index
-        self.index2word = index2word
+        super(Vocab, self).__init__(sorted(_vocab.difference(_stopwords)))
 
 
 def dump(data, filename, protocol=2):
@@ -241,21 +558,376 @@ def dump(data, filename, protocol=2):
             pickle.dump(value, f, protocol=protocol)
 
 
-def load(filename):
+def iterload(filename):
 
     """
-    For pickle loading large pickled lists.
-    From http://stackoverflow.com/a/20725705/1009979
+    Yield, one by one, the values of a list written by `dump`.
 
     """
 
-    data = []
     with open(filename, "rb") as f:
         N = pickle.load(f)
         for _ in xrange(N):
-            data.append(pickle.load(f))
+            yield pickle.load(f)
+
+
+def load(filename):
+
+    """
+    For pickle loading large pickled lists.
+    From http://stackoverflow.com/a/20725705/1009979
+
+    """
+
+    return list(iterload(filename))
+
+
+class _ArrayFileWriter(object):
+
+    """
+    Append values to a one dimensional array that is written straight to
+    disk, so that it need not fit in memory, and close it as an npy file.
+
+    """
+
+    def __init__(self, filename, dtype, buffer_size=65536):
+
+        self.filename = filename
+        self.dtype = numpy.dtype(dtype)
+        self.size = 0
+        self.buffer = []
+        self.buffer_size = buffer_size
+        self.raw_file = open(filename + '.raw', 'wb')
 
-    return data
+    def extend(self, values):
+
+        self.buffer.extend(values)
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+
+        values = numpy.array(self.buffer, dtype=self.dtype)
+        values.tofile(self.raw_file)
+        self.size += len(values)
+        self.buffer = []
+
+    def close(self):
+
+        self.flush()
+        self.raw_file.close()
+
+        header = dict(descr=numpy.lib.format.dtype_to_descr(self.dtype),
+                      fortran_order=False,
+                      shape=(self.size,))
+
+        with open(self.filename, 'wb') as f:
+            numpy.lib.format.write_array_header_1_0(f, header)
+            with open(self.raw_file.name, 'rb') as raw_file:
+                shutil.copyfileobj(raw_file, f)
+
+        os.remove(self.raw_file.name)
+
+        return self.filename
+
+
+class ParagraphStore(object):
+
+    """
+    A columnar store of paragraphs, whose arrays are memory-mapped, so that it
+    opens instantly and paragraphs are read only when accessed.
+
+    The store is a directory holding
+
+    * tokens.npy: the int32 token ids of all paragraphs, concatenated.
+    * offsets.npy: paragraph i's tokens are tokens[offsets[i]:offsets[i+1]].
+    * file_id.npy, div1_index.npy, paragraph_index.npy, paragraph_count.npy:
+      int32 metadata columns, one value per paragraph.
+    * words.json: the word of each token id, which is `vocab`.
+    * corpus_filenames.json: the xml filename of each file id.
+
+    """
+
+    columns = ('file_id', 'div1_index', 'paragraph_index', 'paragraph_count')
+
+    def __init__(self, directory):
+
+        self.directory = directory
+
+        _load = lambda name: numpy.load(os.path.join(directory, name + '.npy'),
+                                        mmap_mode='r')
+
+        self.tokens = _load('tokens')
+        self.offsets = _load('offsets')
+
+        for column in self.columns:
+            setattr(self, column, _load(column))
+
+        with open(os.path.join(directory, 'words.json')) as f:
+            self.vocab = _Vocab(json.load(f))
+
+        with open(os.path.join(directory, 'corpus_filenames.json')) as f:
+            self.corpus_filenames = json.load(f)
+
+    def __len__(self):
+
+        return len(self.offsets) - 1
+
+    def get_token_ids(self, i):
+
+        """
+        Return the token ids of paragraph i, as a view into `tokens`.
+
+        """
+
+        return self.tokens[self.offsets[i]:self.offsets[i+1]]
+
+    def __getitem__(self, i):
+
+        """
+        Return paragraph i in the form returned by get_all_paragraphs.
+
+        """
+
+        if not 0 <= i < len(self):
+            raise IndexError('Paragraph index out of range.')
+
+        words = self.vocab.decode(self.get_token_ids(i))
+
+        return dict(corpus_filename = self.corpus_filenames[self.file_id[i]],
+                    div1_index = int(self.div1_index[i]),
+                    paragraph_index = int(self.paragraph_index[i]),
+                    paragraph_count = int(self.paragraph_count[i]),
+                    words = words,
+                    word_count = len(words))
+
+    def __iter__(self):
+
+        for i in xrange(len(self)):
+            yield self[i]
+
+    @classmethod
+    def write(cls, paragraphs, directory):
+
+        """
+        Write the paragraphs, in the form returned by get_all_paragraphs, to a
+        new store in `directory` and return it. The paragraphs may be any
+        iterable, and the arrays are written to disk as they grow.
+
+        """
+
+        tmp_directory = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(directory)))
+
+        writers = {}
+        for name, dtype in [('tokens', numpy.int32), ('offsets', numpy.int64)]\
+                + [(column, numpy.int32) for column in cls.columns]:
+            writers[name] = _ArrayFileWriter(
+                os.path.join(tmp_directory, name + '.npy'), dtype)
+
+        word2id = {}
+        words = []
+        file2id = {}
+        corpus_filenames = []
+
+        offset = 0
+        writers['offsets'].extend([offset])
+
+        for paragraph_details in paragraphs:
+
+            token_ids = []
+            for word in paragraph_details['words']:
+                try:
+                    token_ids.append(word2id[word])
+                except KeyError:
+                    word2id[word] = len(words)
+                    words.append(word)
+                    token_ids.append(word2id[word])
+
+            corpus_filename = paragraph_details['corpus_filename']
+            if corpus_filename not in file2id:
+                file2id[corpus_filename] = len(corpus_filenames)
+                corpus_filenames.append(corpus_filename)
+
+            offset += len(token_ids)
+
+            writers['tokens'].extend(token_ids)
+            writers['offsets'].extend([offset])
+            writers['file_id'].extend([file2id[corpus_filename]])
+            for column in cls.columns[1:]:
+                writers[column].extend([paragraph_details[column]])
+
+        for writer in writers.values():
+            writer.close()
+
+        with open(os.path.join(tmp_directory, 'words.json'), 'w') as f:
+            json.dump(words, f)
+
+        with open(os.path.join(tmp_directory, 'corpus_filenames.json'), 'w') as f:
+            json.dump(corpus_filenames, f)
+
+        utils.set_default_permissions(tmp_directory)
+        os.rename(tmp_directory, directory)
+
+        return cls(directory)
+
+    @classmethod
+    def from_pickle(cls, filenames, directory):
+
+        """
+        Convert paragraphs pickled with `dump`, e.g. the shards written by
+        get_all_paragraphs_sharded, to a new store in `directory`.
+
+        """
+
+        return cls.write(iter_shards(filenames), directory)
+
+
+def iter_texts(paragraphs, vocab, min_length=251, max_length=499):
+
+    """
+    Group the paragraphs, in the form returned by get_all_paragraphs, into
+    texts of between `min_length` and `max_length` words, counting only the
+    words in the vocab. Yield each text, as a list of its vocab words, as soon
+    as it is complete.
+
+    A text is made of consecutive paragraphs of the same div1 of the same
+    file. Paragraphs are added to it until it has at least `min_length`
+    words. If adding a paragraph would take it over `max_length`, the text so
+    far is discarded and a new one started with that paragraph.
+
+    """
+
+    word2index = vocab.word2index
+
+    text = []
+    text_key = None
+
+    for paragraph_details in paragraphs:
+
+        words = [word for word in paragraph_details['words']
+                 if word in word2index]
+
+        key = (paragraph_details['corpus_filename'],
+               paragraph_details['div1_index'])
+
+        if key != text_key or len(text) + len(words) > max_length:
+            text = []
+            text_key = key
+
+        text.extend(words)
+
+        if len(text) >= min_length:
+            if len(text) <= max_length:
+                yield text
+            text = []
+
+
+def write_texts(paragraphs, vocab, directory, min_length=251, max_length=499,
+                prefix='bnc_texts'):
+
+    """
+    Segment the paragraphs into texts with iter_texts and write them, in a
+    single pass, both as a bz2 text file, with one text per line and its
+    words delimited by "|", and as an npz file with the word indices `w`,
+    text indices `d` and `vocabulary` arrays.
+
+    The files are named, like those in the cache, by the total number of
+    words and texts and the length range, e.g.
+    bnc_texts_78639361_183975_251_499.txt.bz2. Return their filenames.
+
+    """
+
+    tmp_directory = tempfile.mkdtemp(dir=directory)
+
+    text_file = bz2.BZ2File(os.path.join(tmp_directory, 'texts.txt.bz2'), 'w')
+    writers = dict(w=_ArrayFileWriter(os.path.join(tmp_directory, 'w.npy'),
+                                      numpy.int32),
+                   d=_ArrayFileWriter(os.path.join(tmp_directory, 'd.npy'),
+                                      numpy.int32))
+
+    words_count = 0
+    texts_count = 0
+    for text in iter_texts(paragraphs, vocab, min_length, max_length):
+
+        text_file.write('|'.join(text) + '\n')
+
+        writers['w'].extend(vocab.encode(text))
+        writers['d'].extend([texts_count] * len(text))
+
+        words_count += len(text)
+        texts_count += 1
+
+    text_file.close()
+
+    for writer in writers.values():
+        writer.close()
+
+    numpy.save(os.path.join(tmp_directory, 'vocabulary.npy'),
+               numpy.array(vocab.vocab))
+
+    with zipfile.ZipFile(os.path.join(tmp_directory, 'texts.npz'), 'w',
+                         zipfile.ZIP_STORED, allowZip64=True) as npz_file:
+        for name in ('w', 'd', 'vocabulary'):
+            npz_file.write(os.path.join(tmp_directory, name + '.npy'),
+                           name + '.npy')
+
+    basename = '%s_%d_%d_%d_%d' % (prefix,
+                                   words_count,
+                                   texts_count,
+                                   min_length,
+                                   max_length)
+
+    filenames = []
+    for extension in ('.txt.bz2', '.npz'):
+        filename = os.path.join(directory, basename + extension)
+        os.rename(os.path.join(tmp_directory, 'texts' + extension), filename)
+        filenames.append(filename)
+
+    shutil.rmtree(tmp_directory)
+
+    return filenames
+
+
+def _get_corpus_vocabulary():
+
+    """
+    The words in the vocab file minus the stopwords.
+
+    """
+
+    return Vocab(vocab=get_brief_vocabulary(), stopwords=get_stopwords_list())
+
+
+def _count_words(paragraphs, vocab, chunk_size=1000000):
+
+    """
+    Return the array of the frequency of each word of the vocab in the
+    paragraphs. The words are encoded to indices and counted with bincount
+    in chunks of around `chunk_size` words.
+
+    """
+
+    V = len(vocab)
+    counts = numpy.zeros(V, dtype=numpy.int64)
+
+    get_index = vocab.word2index.get
+
+    indices = []
+    for paragraph_details in paragraphs:
+
+        indices.extend([get_index(word, -1) for word in paragraph_details['words']])
+
+        if len(indices) >= chunk_size:
+            indices = numpy.array(indices, dtype=numpy.int32)
+            counts += numpy.bincount(indices[indices >= 0], minlength=V)
+            indices = []
+
+    indices = numpy.array(indices, dtype=numpy.int32)
+    counts += numpy.bincount(indices[indices >= 0], minlength=V)
+
+    return counts
 
 
 def get_corpus_vocabulary(paragraphs):
@@ -269,23 +941,77 @@ def get_corpus_vocabulary(paragraphs):
 
     """
 
+    vocab = _get_corpus_vocabulary()
 
-    stopwords = dict.fromkeys(get_stopwords_list())
-    acceptable_word_list = get_brief_vocabulary()
+    counts = _count_words(paragraphs, vocab)
 
-    word_counter = dict.fromkeys(acceptable_word_list, 0)
+    return dict(zip(vocab.vocab, counts.tolist()))
 
-    for paragraph_details in paragraphs:
-        for word in paragraph_details['words']:
-            try:
-                word_counter[word] += 1
-            except KeyError:
-                pass
-            
-
-    # Clear out the stop words
-    for word in word_counter.keys():
-        if word in stopwords:
-            del word_counter[word]
-
-    return word_counter
+
+_worker_vocab = None
+
+def _initialize_word_counting_worker(vocab):
+
+    global _worker_vocab
+    _worker_vocab = vocab
+
+
+def _count_shard_words(shard_filename):
+
+    return _count_words(iterload(shard_filename), _worker_vocab)
+
+
+def get_corpus_vocabulary_parallel(shard_filenames, processes=None):
+
+    """
+    As get_corpus_vocabulary, but for the paragraphs stored in the shards
+    written by get_all_paragraphs_sharded. The shards are counted by a pool of
+    `processes` processes, by default one per cpu, and their counts summed.
+
+    """
+
+    vocab = _get_corpus_vocabulary()
+    counts = numpy.zeros(len(vocab), dtype=numpy.int64)
+
+    pool = multiprocessing.Pool(processes,
+                                initializer=_initialize_word_counting_worker,
+                                initargs=(vocab,))
+
+    try:
+        for shard_counts in pool.imap_unordered(_count_shard_words,
+                                                shard_filenames):
+            counts += shard_counts
+
+        pool.close()
+
+    except:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
+
+    return dict(zip(vocab.vocab, counts.tolist()))
+
+
+def get_store_corpus_vocabulary(store, chunk_size=10000000):
+
+    """
+    As get_corpus_vocabulary, but for the paragraphs in a ParagraphStore. The
+    store's token ids are mapped to vocabulary indices and counted in chunks
+    of `chunk_size` tokens, with no per-word Python loop.
+
+    """
+
+    vocab = _get_corpus_vocabulary()
+
+    V = len(vocab)
+
+    token_id_to_index = vocab.encode(store.vocab.vocab)
+
+    counts = numpy.zeros(V, dtype=numpy.int64)
+    for start in xrange(0, len(store.tokens), chunk_size):
+        indices = token_id_to_index[store.tokens[start:start+chunk_size]]
+        counts += numpy.bincount(indices[indices >= 0], minlength=V)
+
+    return dict(zip(vocab.vocab, counts.tolist()))
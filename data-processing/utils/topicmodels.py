@@ -1,15 +1,14 @@
 from __future__ import division, absolute_import
 
 from itertools import cycle
-import configobj
-from numpy import zeros, array, arange, sqrt, dot, unique
-from numpy import random
-from gustav.samplers import fortransamplers
-from numpy.random import randint, rand
 import os
 
 from . import utils
 
+configobj = utils.lazy_import('configobj')
+numpy = utils.lazy_import('numpy')
+fortransamplers = utils.lazy_import('gustav.samplers.fortransamplers')
+
 
 def get_experiment_texts(cfg_file, cache):
 
@@ -57,7 +56,7 @@ class PosteriorPredictive(object):
 
         self.am = state['m'] * state['a']
 
-        S = zeros((self.K, self.V), dtype=int)
+        S = numpy.zeros((self.K, self.V), dtype=int)
 
         for xi, wi in zip(state['x'], state['w']):
             S[xi, wi] += 1
@@ -68,7 +67,16 @@ class PosteriorPredictive(object):
         self._set_seed()
 
     def _set_seed(self, seed=None):
-        self.random = random.RandomState(seed=seed)
+        self.random = numpy.random.RandomState(seed=seed)
+
+    def memoize_key(self):
+
+        '''
+        What identifies the model when memoizing its posterior predictions
+        with utils.memoize.
+        '''
+
+        return (self.vocabulary, self.am, self.phi)
 
     def sample_vpi(self, text, iterations=1000, vpi_init=None, burn_in=False):
 
@@ -85,7 +93,7 @@ class PosteriorPredictive(object):
         w = [self.word_to_index[word] for word in words
              if word in self.word_to_index]
 
-        w = array(w)
+        w = numpy.array(w)
         
         if vpi_init is None:
             vpi = self.random.dirichlet(self.am)
@@ -93,7 +101,7 @@ class PosteriorPredictive(object):
             vpi = vpi_init
 
         if not burn_in:
-            Vpi = zeros((iterations, self.K))
+            Vpi = numpy.zeros((iterations, self.K))
 
         for iteration in xrange(iterations):
 
@@ -104,7 +112,7 @@ class PosteriorPredictive(object):
 
             assert _K == self.K
 
-            R = zeros(self.K)
+            R = numpy.zeros(self.K)
 
             for xi in [sample(p=Q[:,i], choice=self.random.choice) for i in xrange(nj)]:
                 R[xi] += 1
@@ -182,16 +190,16 @@ class PosteriorPredictive(object):
 
                 if self.verbose:
                     print('rhat: %2.2f' % rhat_max)
-                vpi_init = array([vpi[-1] for vpi in vpi_list])
+                vpi_init = numpy.array([vpi[-1] for vpi in vpi_list])
 
         vpi = flatten(vpi_list)
 
         N, V = vpi.shape
 
-        w = zeros(self.V)
+        w = numpy.zeros(self.V)
         I = self.random.permutation(N)[:min(N,thin)]
         for p in vpi[I]:
-            w += dot(p, self.phi)
+            w += numpy.dot(p, self.phi)
 
         w = w/len(I)
 
@@ -235,7 +243,7 @@ def topic2str(phi, vocabulary, K=25):
 
 def sample(p, choice, size=None):
     K = len(p)
-    return choice(arange(K), p=p, size=size, replace=True)
+    return choice(numpy.arange(K), p=p, size=size, replace=True)
 
 
 def flatten(P):
@@ -244,7 +252,7 @@ def flatten(P):
     for p in P:
         _P.extend(p)
 
-    return array(_P)
+    return numpy.array(_P)
 
 
 def convergence_diagnostic(vpi_list, high_mass_limit=0.99):
@@ -261,15 +269,15 @@ def convergence_diagnostic(vpi_list, high_mass_limit=0.99):
 
     n, K = vpi_list[0].shape
 
-    var_j = array([p.var(0, ddof=1) for p in vpi_list])
-    mean_j = array([p.mean(0) for p in vpi_list])
+    var_j = numpy.array([p.var(0, ddof=1) for p in vpi_list])
+    mean_j = numpy.array([p.mean(0) for p in vpi_list])
 
     W = var_j.mean(0)
     B = mean_j.var(0, ddof=1) * n
 
     var_alt = (n-1)/n * W + (1/n) * B
 
-    _rhat =  sqrt(var_alt/W)
+    _rhat =  numpy.sqrt(var_alt/W)
 
     _vpi = flatten(vpi_list)
 
@@ -283,7 +291,7 @@ def convergence_diagnostic(vpi_list, high_mass_limit=0.99):
         if f >= high_mass_limit:
             break
 
-    return _rhat[array(top_k)]
+    return _rhat[numpy.array(top_k)]
 
 
 class DirichletMultinomialCompound(object):
@@ -305,7 +313,7 @@ class DirichletMultinomialCompound(object):
         try:
             self.psi = inits['psi']
         except KeyError:
-            _psi = rand(self.V)
+            _psi = numpy.random.rand(self.V)
             self.psi = _psi/_psi.sum()
 
         try:
@@ -366,9 +374,9 @@ class DirichletMultinomialCompound(object):
     def _sample_bpsi(self, seed=None):
 
         if seed is None:
-            seed = randint(101, 1000001)
+            seed = numpy.random.randint(101, 1000001)
 
-        I = unique(self.S)
+        I = numpy.unique(self.S)
 
         self.sigma_s_colsums, self.b, self.psi\
             = fortransamplers.polya_sampler_bpsi2(self.S, 
@@ -385,9 +393,9 @@ class DirichletMultinomialCompound(object):
     def _sample_c(self, seed=None):
 
         if seed is None:
-            seed = randint(101, 1000001)
+            seed = numpy.random.randint(101, 1000001)
 
-        I = unique(self.sigma_s_colsums)
+        I = numpy.unique(self.sigma_s_colsums)
 
         self.c = fortransamplers.polya_sampler_c2(self.sigma_s_colsums,  
                                                   I,
@@ -8,16 +8,62 @@ Some general utils.
 #=============================================================================
 import string 
 import re
+import io
 import os
 import errno
 import hashlib
-import urllib
-import bz2
-import numpy
+import json
+import time
+import inspect
+import functools
+import contextlib
+import fcntl
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import zipfile
+import collections
+import importlib
+import types
 import cPickle as pickle
+from multiprocessing.pool import ThreadPool
 
 #================================ End Imports ================================
 
+class _LazyModule(types.ModuleType):
+
+    '''
+    A stand-in for a module that imports it when one of its attributes is
+    first used, and from then on holds the module's attributes itself.
+    '''
+
+    def __getattr__(self, attribute):
+
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+
+        return getattr(module, attribute)
+
+
+def lazy_import(name):
+
+    '''
+    Return a stand-in for the module `name`, which is only imported when it
+    is first used. This keeps heavy dependencies out of the startup of
+    worker processes and scripts that do not use them.
+
+        numpy = lazy_import('numpy')
+
+    '''
+
+    return _LazyModule(name)
+
+
+numpy = lazy_import('numpy')
+urllib2 = lazy_import('urllib2')
+bz2 = lazy_import('bz2')
+
 def deletechars(s, exclude_chars):
     ''' Fast deletion of characters from string.
     It uses a dummy translation table, and so no mapping is applied, and we
@@ -32,6 +78,20 @@ def deletepunctuation(s):
     return deletechars(s,string.punctuation)
 
 
+_possessive_pattern = re.compile(r'\'s')
+
+# Characters deleted by tokenize: everything but printable ascii, and
+# punctuation.
+_tokenize_deletechars = ''.join([chr(i) for i in xrange(256)
+                                 if chr(i) not in string.printable])\
+                        + string.punctuation
+
+# tokenize_many joins texts with a separator that tokenize would delete, and
+# so must be kept when tokenizing the joined texts.
+_tokenize_many_separator = '\x00'
+_tokenize_many_deletechars = _tokenize_deletechars.replace(_tokenize_many_separator, '')
+
+
 def tokenize(text, foldcase=True):
     ''' 
     A very cheap and easy tokenization.
@@ -39,19 +99,51 @@ def tokenize(text, foldcase=True):
     Second, zap utf-8 chars.
     Then, remove all punctuation and, by default, fold upper and lower case words
     and then split by whitespace.
+
+    The non-ascii characters are zapped by an ascii encoding, and the
+    non-printable characters and punctuation deleted together using a
+    single str.translate.
     '''
 
-    text = re.sub(r'\'s','', text)
-    s = ''.join([s for s in text if s in string.printable])
+    text = _possessive_pattern.sub('', text)
 
-    s = str(s) # Got to convert it to str.
-    s = deletepunctuation(s)
+    if isinstance(text, unicode):
+        text = text.encode('ascii', 'ignore')
+
+    s = text.translate(None, _tokenize_deletechars)
 
     if foldcase:
         s = s.lower()
     return s.split()
 
 
+def tokenize_many(texts, foldcase=True):
+    '''
+    Tokenize each of the texts, as tokenize does, and return the list of
+    their lists of words.
+
+    Texts that are all str are joined together, so that each step of the
+    tokenization is done once for the whole batch.
+    '''
+
+    texts = list(texts)
+
+    if texts and all([isinstance(text, str) for text in texts]):
+
+        joined_texts = _tokenize_many_separator.join(texts)
+
+        if joined_texts.count(_tokenize_many_separator) == len(texts) - 1:
+
+            s = _possessive_pattern.sub('', joined_texts)
+            s = s.translate(None, _tokenize_many_deletechars)
+
+            if foldcase:
+                s = s.lower()
+            return [text.split() for text in s.split(_tokenize_many_separator)]
+
+    return [tokenize(text, foldcase=foldcase) for text in texts]
+
+
 def mkdir_p(path):
     '''
     Make a directory, making parents if necessary.
@@ -66,7 +158,22 @@ def mkdir_p(path):
         else: raise
 
 
-def checksum(argument, algorithm='sha256'):
+def set_default_permissions(path):
+
+    '''
+    Give a file or directory made by tempfile.mkstemp or mkdtemp, which are
+    only accessible by their owner, the permissions of one made by open or
+    os.mkdir under the current umask.
+    '''
+
+    umask = os.umask(0)
+    os.umask(umask)
+
+    os.chmod(path, (0o777 if os.path.isdir(path) else 0o666) & ~umask)
+
+
+def checksum(argument, algorithm='sha256', chunk_size=1 << 20):
+
     '''
     Returns the hash checksum of `argument'.
     If `argument' is a name of a file, then perform the checksum on the file.
@@ -74,23 +181,91 @@ def checksum(argument, algorithm='sha256'):
     By default, it will be the sha1 checksum (and so equivalent to linux's
     sha1sum). Alternatively, the algorithm could be md5 (equivalent to linux's
     md5sum), or else sha224, sha256, sha384, sha512.
+    Files are read in chunks of `chunk_size` bytes, not all at once.
     '''
 
     h = hashlib.new(algorithm)
 
     if os.path.exists(argument) and os.path.isfile(argument):
-        argument = open(argument,'rb').read()
-
-    h.update(argument)
+        with open(argument, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+    else:
+        h.update(argument)
 
     return h.hexdigest()
 
 
-def verify_cache_files(filenames, cache='_cache', verbose=False):
+class ChecksumCache(object):
+
+    '''
+    A persistent cache of file checksums, stored as json in `filename`. A
+    file's cached checksum is used as long as its size, mtime and inode are
+    unchanged. It is safe to use from several threads.
+    '''
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.lock = threading.Lock()
+
+        try:
+            with open(filename) as f:
+                self.checksums = json.load(f)
+        except (IOError, ValueError):
+            self.checksums = {}
+
+    def checksum(self, filepath, algorithm='sha256'):
+
+        key = '%s:%s' % (algorithm, os.path.abspath(filepath))
+
+        stat = os.stat(filepath)
+        file_stat = [stat.st_size, stat.st_mtime, stat.st_ino]
+
+        with self.lock:
+            entry = self.checksums.get(key)
+
+        if entry is not None and entry['stat'] == file_stat:
+            return entry['checksum']
+
+        file_checksum = checksum(filepath, algorithm=algorithm)
+
+        with self.lock:
+            self.checksums[key] = dict(stat=file_stat, checksum=file_checksum)
+
+        return file_checksum
+
+    def save(self):
+
+        with self.lock:
+
+            fd, tmp_filename = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.filename)))
+
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.checksums, f)
+
+                set_default_permissions(tmp_filename)
+                os.rename(tmp_filename, self.filename)
+
+            except:
+                os.remove(tmp_filename)
+                raise
+
+
+checksum_cache_filename = '.checksums.json'
+
+
+def verify_cache_files(filenames, cache='_cache', verbose=False, threads=8):
 
     '''
     Check if files exist in the cache directory. Check their integrity.
 
+    Checksums are calculated by a pool of `threads` threads, and kept in a
+    checksum cache in the cache directory, so that unchanged files are not
+    read again.
+
     '''
 
     mkdir_p(cache) # Make dir unless it already exists
@@ -107,11 +282,29 @@ def verify_cache_files(filenames, cache='_cache', verbose=False):
                   )
             raise
 
+    checksum_cache = ChecksumCache(os.path.join(cache, checksum_cache_filename))
+
+    pool = ThreadPool(threads)
+    try:
+        local_checksums = pool.map(
+            lambda filename: checksum_cache.checksum(os.path.join(cache, filename)),
+            [filename for filename, _ in filenames])
+    finally:
+        pool.close()
+        pool.join()
+        try:
+            checksum_cache.save()
+        except (IOError, OSError):
+            pass # E.g. a read-only cache. The checksums are found again next time.
+
+    for (filename, file_checksum), local_checksum in zip(filenames,
+                                                         local_checksums):
+
         try:
             if verbose:
                 print('Check integrity of file %s.' % filename)
 
-            assert checksum(local_filepath) == file_checksum 
+            assert local_checksum == file_checksum 
 
             if verbose:
                 print('Integrity check complete.')
@@ -120,41 +313,136 @@ def verify_cache_files(filenames, cache='_cache', verbose=False):
             raise AssertionError('File %s failed integrity check.' % filename)
 
 
+def _download(url, local_filepath, file_checksum, algorithm='sha256',
+              chunk_size=1 << 16, verbose=False):
+
+    '''
+    Download `url` to `local_filepath`, and return its checksum, calculated
+    as it is downloaded. The download goes to a .part file, which is resumed
+    if it exists, and is renamed when complete if its checksum is
+    `file_checksum`, or else removed.
+
+    '''
+
+    part_filepath = local_filepath + '.part'
+
+    h = hashlib.new(algorithm)
+    size = 0
+
+    if os.path.exists(part_filepath):
+        with open(part_filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+                size += len(chunk)
+
+    request = urllib2.Request(url)
+    if size:
+        request.add_header('Range', 'bytes=%d-' % size)
+
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        if e.code != 416: # The range starts at the end of the file.
+            raise
+        response = None
+
+    start_time = time.time()
+    downloaded = 0
+
+    if response is not None:
+
+        try:
+
+            if size and response.getcode() != 206:
+                # The server ignored the range, so start again.
+                h = hashlib.new(algorithm)
+                size = 0
+
+            with open(part_filepath, 'ab' if size else 'wb') as f:
+                for chunk in iter(lambda: response.read(chunk_size), b''):
+                    h.update(chunk)
+                    f.write(chunk)
+                    downloaded += len(chunk)
+
+        finally:
+            response.close()
+
+    local_checksum = h.hexdigest()
+
+    if local_checksum == file_checksum:
+        os.rename(part_filepath, local_filepath)
+    else:
+        os.remove(part_filepath)
+
+    if verbose:
+        elapsed = max(time.time() - start_time, 1e-6)
+        print('Downloaded %s: %2.1f MB in %2.1f s (%2.1f MB/s)%s.'
+              % (os.path.basename(local_filepath),
+                 downloaded / 1e6,
+                 elapsed,
+                 downloaded / 1e6 / elapsed,
+                 ', resumed at %d bytes' % size if size else ''))
+
+    return local_checksum
+
+
 # TODO (Tue 30 May 2017 20:30:06 BST): Obselete now?
-def curl(root, filenames, cache='_cache', verbose=False):
+def curl(root, filenames, cache='_cache', verbose=False, threads=8):
 
     '''
     Download necessary files for the topic model, unless they are already there.
     Check file integrity then.
 
+    Files are downloaded by a pool of `threads` threads, and checksummed as
+    they are downloaded. Interrupted downloads are resumed.
+
     '''
 
     mkdir_p(cache) # Make dir unless it already exists
-    
-    for filename, file_checksum in filenames:
+
+    checksum_cache = ChecksumCache(os.path.join(cache, checksum_cache_filename))
+
+    def get_checksum(filename, file_checksum):
 
         local_filepath = os.path.join(cache, filename)
 
-        try:
-            assert os.path.exists(local_filepath)
-        except AssertionError:
+        if os.path.exists(local_filepath):
+            return checksum_cache.checksum(local_filepath)
 
-            url = os.path.join(root, filename)
+        url = os.path.join(root, filename)
 
-            if verbose:
-                print('Downloading %s' % url)
+        if verbose:
+            print('Downloading %s' % url)
 
-            f = urllib.URLopener()
-            f.retrieve(url, local_filepath)     
+        local_checksum = _download(url,
+                                   local_filepath,
+                                   file_checksum,
+                                   verbose=verbose)
 
-            if verbose:
-                print('Download complete.')
+        if verbose:
+            print('Download complete.')
+
+        return local_checksum
+
+    pool = ThreadPool(threads)
+    try:
+        local_checksums = pool.map(lambda args: get_checksum(*args), filenames)
+    finally:
+        pool.close()
+        pool.join()
+        try:
+            checksum_cache.save()
+        except (IOError, OSError):
+            pass # E.g. a read-only cache. The checksums are found again next time.
+
+    for (filename, file_checksum), local_checksum in zip(filenames,
+                                                         local_checksums):
 
         try:
             if verbose:
                 print('Check integrity of file %s.' % filename)
 
-            assert checksum(local_filepath) == file_checksum 
+            assert local_checksum == file_checksum 
 
             if verbose:
                 print('Integrity check complete.')
@@ -162,11 +450,150 @@ def curl(root, filenames, cache='_cache', verbose=False):
         except AssertionError:
             raise AssertionError('File %s failed integrity check.' % filename)
 
-def _load_bz2(filename, cache, func, verbose=False):
+_bz2_chunk_size = 1 << 20
+
+# The header of a bz2 stream followed by the magic number of its first block.
+_bz2_stream_header = re.compile(b'BZh[1-9]1AY&SY')
+
+
+def _decompress_bz2(source, destination, size=None):
+
+    '''
+    Decompress, in chunks, the bz2 streams read from the file object `source`,
+    reading at most `size` bytes, and write them to the file object
+    `destination`. Return whether the data ended at the end of a stream.
+    '''
+
+    decompressor = bz2.BZ2Decompressor()
+
+    while size is None or size > 0:
+
+        chunk = source.read(_bz2_chunk_size if size is None
+                            else min(_bz2_chunk_size, size))
+        if not chunk:
+            break
+        if size is not None:
+            size -= len(chunk)
+
+        while chunk:
+            try:
+                destination.write(decompressor.decompress(chunk))
+            except EOFError:
+                # A stream has ended and the chunk starts the next one.
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = bz2.BZ2Decompressor()
+
+    try:
+        decompressor.decompress(b'')
+    except EOFError:
+        return True
+
+    return False
+
+
+def _find_bz2_streams(filepath, first_stream_size=2 << 20):
+
+    '''
+    Return the offsets of what look like the starts of the bz2 streams of a
+    file, as written by parallel compressors like pbzip2. The header may also
+    occur by chance inside compressed data, so the segments between these
+    offsets must be checked when they are decompressed.
+
+    Parallel compressors write streams of one block of at most 900k, so if
+    there is no second header in the first `first_stream_size` bytes, the
+    file is taken to be a single stream and the rest is not scanned.
+    '''
+
+    offsets = []
+    overlap = len(b'BZh91AY&SY') - 1
+
+    with open(filepath, 'rb') as f:
+
+        position, tail = 0, b''
+
+        for chunk in iter(lambda: f.read(_bz2_chunk_size), b''):
+
+            data = tail + chunk
+            for match in _bz2_stream_header.finditer(data):
+                offsets.append(position - len(tail) + match.start())
+
+            position += len(chunk)
+            tail = data[-overlap:]
+
+            if len(offsets) < 2 and position >= first_stream_size:
+                return offsets[:1]
+
+    return offsets
+
+
+def _decompress_bz2_segment(filepath_start_end):
+
+    '''
+    Return the decompressed data of the bz2 streams between the offsets
+    `start` and `end` of a file, or None if they are not whole streams.
+    '''
+
+    filepath, start, end = filepath_start_end
+
+    data = io.BytesIO()
+
+    try:
+        with open(filepath, 'rb') as source:
+            source.seek(start)
+            if _decompress_bz2(source, data, size=end - start):
+                return data.getvalue()
+    except IOError:
+        pass
+
+    return None
+
+
+def _decompress_bz2_parallel(filepath, destination, offsets, processes=None):
+
+    '''
+    Decompress the segments of a multi-stream bz2 file starting at `offsets`
+    in parallel, and append them in order to the file object `destination`.
+    Return False, with `destination` truncated back to where it was, if any
+    segment is not a whole number of streams.
+    '''
+
+    ends = offsets[1:] + [os.path.getsize(filepath)]
+    start = destination.tell()
+
+    pool = multiprocessing.Pool(processes)
+    try:
+
+        for data in pool.imap(_decompress_bz2_segment,
+                              zip([filepath] * len(offsets), offsets, ends)):
+
+            if data is None:
+                destination.seek(start)
+                destination.truncate()
+                return False
+
+            destination.write(data)
+
+        pool.close()
+        return True
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _load_bz2(filename, cache, func, verbose=False, processes=None):
 
     '''
     Load a bz2 data file.
 
+    The file is uncompressed in chunks to a temporary file that is renamed
+    when complete. A file of several bz2 streams is uncompressed by a pool of
+    `processes` processes, one stream at a time, unless `processes` is 1 or
+    this is a pool worker.
+
     '''
 
     local_filepath = os.path.join(cache, filename)
@@ -186,20 +613,45 @@ def _load_bz2(filename, cache, func, verbose=False):
             if verbose:
                 print('Uncompressing %s to %s' % (filename, basename))
 
-            # Read bunzipped data to tmp_data
-            with bz2.BZ2File(local_filepath) as f:
-                tmp_data = f.read()
+            # Pool workers are daemonic, and cannot start a pool themselves.
+            if processes != 1 and not multiprocessing.current_process().daemon:
+                offsets = _find_bz2_streams(local_filepath)
+            else:
+                offsets = []
+
+            fd, tmp_filename = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(basename)))
+
+            try:
+
+                with os.fdopen(fd, 'wb') as f:
 
-            # Write tmp_data to filename without bz2 extension
-            with open(basename, 'wb') as f:
-                f.write(tmp_data)
+                    if not (len(offsets) > 1 and offsets[0] == 0
+                            and _decompress_bz2_parallel(local_filepath,
+                                                         f,
+                                                         offsets,
+                                                         processes=processes)):
+
+                        with open(local_filepath, 'rb') as source:
+                            if not _decompress_bz2(source, f):
+                                raise EOFError('Compressed file %s ended before the '
+                                               'end of its stream.' % filename)
+
+                set_default_permissions(tmp_filename)
+
+                os.rename(tmp_filename, basename)
+
+            except:
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+                raise
 
         return func(basename)
 
     else:
         raise Exception('Expecting a bz2 file.')
 
-def loadcsv(filename, cache, verbose=False):
+def loadcsv(filename, cache, verbose=False, processes=None):
 
     '''
     Load a bz2-ed csv data file.
@@ -209,9 +661,10 @@ def loadcsv(filename, cache, verbose=False):
     return _load_bz2(filename=filename, 
                      cache=cache, 
                      func=lambda arg: open(arg).read().strip().split('\n'),
-                     verbose=verbose)
+                     verbose=verbose,
+                     processes=processes)
 
-def loadnpz(filename, cache, verbose=False):
+def loadnpz(filename, cache, verbose=False, processes=None):
 
     '''
     Load a bz2 numpy npz data file.
@@ -221,10 +674,152 @@ def loadnpz(filename, cache, verbose=False):
     return _load_bz2(filename=filename, 
                      cache=cache, 
                      func=numpy.load, 
-                     verbose=verbose)
+                     verbose=verbose,
+                     processes=processes)
+
+
+array_manifest_filename = 'manifest.json'
+
+
+def _read_npy_header(filename):
+
+    with open(filename, 'rb') as f:
+
+        version = numpy.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(f)
+
+    return shape, dtype
+
+
+def _write_array_directory(npz_filename, directory):
+
+    '''
+    Stream each member of an npz file into its own npy file in `directory`,
+    along with a manifest of the arrays' shapes and dtypes.
+    '''
+
+    manifest = {}
+
+    with zipfile.ZipFile(npz_filename) as npz:
+
+        for member in npz.namelist():
+
+            name, extension = os.path.splitext(member)
+            assert extension == '.npy', 'Expecting npy files in %s.' % npz_filename
+
+            filename = os.path.join(directory, member)
+            with npz.open(member) as source, open(filename, 'wb') as f:
+                shutil.copyfileobj(source, f, 1 << 20)
+
+            shape, dtype = _read_npy_header(filename)
 
+            manifest[name] = dict(filename=member,
+                                  shape=list(shape),
+                                  dtype=dtype.str if not dtype.hasobject else 'object',
+                                  mmap=not dtype.hasobject)
 
-def bunzip(filename, cache, verbose=False):
+    with open(os.path.join(directory, array_manifest_filename), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+class ArrayDirectory(collections.Mapping):
+
+    '''
+    A read-only mapping of the arrays of a directory written by
+    _write_array_directory. Each array is opened the first time it is
+    accessed, and memory-mapped with `mmap_mode`, unless it has an object
+    dtype and has to be loaded.
+    '''
+
+    def __init__(self, directory, mmap_mode='r'):
+
+        self.directory = directory
+        self.mmap_mode = mmap_mode
+
+        with open(os.path.join(directory, array_manifest_filename)) as f:
+            self.manifest = json.load(f)
+
+        self.arrays = {}
+
+    def __getitem__(self, name):
+
+        if name not in self.arrays:
+
+            entry = self.manifest[name]
+
+            self.arrays[name] = numpy.load(
+                os.path.join(self.directory, entry['filename']),
+                mmap_mode=self.mmap_mode if entry['mmap'] else None,
+                allow_pickle=not entry['mmap'])
+
+        return self.arrays[name]
+
+    def __iter__(self):
+
+        return iter(sorted(self.manifest))
+
+    def __len__(self):
+
+        return len(self.manifest)
+
+    @property
+    def files(self):
+
+        '''
+        The names of the arrays, like the `files` of a numpy.load of an npz.
+        '''
+
+        return sorted(self.manifest)
+
+
+def loadarrays(filename, cache, verbose=False, mmap_mode='r', processes=None):
+
+    '''
+    Load a numpy npz data file, like loadnpz, as memory-mapped arrays. The
+    file can be bz2-ed, as for loadnpz, or a plain npz file.
+
+    The first time, the members of the npz file are written as npy files to
+    a directory, named like the npz file with an .arrays extension, in the
+    cache. Loading it again opens the arrays lazily, and they are shared
+    through the page cache between processes.
+
+    '''
+
+    if os.path.splitext(filename)[1] == '.bz2':
+        npz_filename = _load_bz2(filename=filename,
+                                 cache=cache,
+                                 func=lambda arg: arg,
+                                 verbose=verbose,
+                                 processes=processes)
+    else:
+        npz_filename = os.path.join(cache, filename)
+
+    directory = os.path.splitext(npz_filename)[0] + '.arrays'
+
+    if not os.path.exists(os.path.join(directory, array_manifest_filename)):
+
+        if verbose:
+            print('Writing the arrays of %s to %s' % (os.path.basename(npz_filename),
+                                                       directory))
+
+        tmp_directory = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(directory)))
+        try:
+            _write_array_directory(npz_filename, tmp_directory)
+
+            set_default_permissions(tmp_directory)
+
+            os.rename(tmp_directory, directory)
+        except:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            raise
+
+    return ArrayDirectory(directory, mmap_mode=mmap_mode)
+
+
+def bunzip(filename, cache, verbose=False, processes=None):
 
     '''
     Unzip a bz2 data file that is in the cache. Store its
@@ -237,12 +832,420 @@ def bunzip(filename, cache, verbose=False):
     return _load_bz2(filename=filename, 
                      cache=cache, 
                      func=lambda arg: None,
-                     verbose=verbose)
+                     verbose=verbose,
+                     processes=processes)
 
 def save_pkl(filename, **kwargs):
-    with open(filename, 'wb') as f:
-        pickle.dump(kwargs, f, protocol=2)
+    '''
+    Pickle the keyword arguments as a dictionary with dump_pkl, so that
+    their large arrays are written to sidecar files.
+    '''
+    dump_pkl(kwargs, filename)
+
+
+def get_sidecar_directory(filename):
+
+    '''
+    The directory of the npy files of the arrays of a pickle file written
+    by dump_pkl.
+    '''
+
+    return filename + '.arrays'
+
+
+def dump_pkl(obj, filename, threshold=1 << 20):
+
+    '''
+    Pickle `obj` to `filename`, writing each numpy array of at least
+    `threshold` bytes, including those inside pandas objects, to its own npy
+    file in a sidecar directory instead of through the pickle stream. Arrays
+    of objects and subclasses of ndarray other than memmap are always
+    pickled. load_pkl
+    memory-maps the sidecar arrays.
+    '''
+
+    sidecar_directory = get_sidecar_directory(filename)
+    parent_directory = os.path.dirname(os.path.abspath(filename))
+
+    tmp_directory = tempfile.mkdtemp(dir=parent_directory)
+    sidecar_filenames = []
+
+    def persistent_id(value):
+
+        # Subclasses, like numpy.matrix, are pickled, to keep their type,
+        # but memmaps, such as those from load_pkl, are plain arrays.
+        if (type(value) in (numpy.ndarray, numpy.memmap)
+            and not value.dtype.hasobject
+            and value.nbytes >= threshold):
+
+            sidecar_filename = '%d.npy' % len(sidecar_filenames)
+            numpy.save(os.path.join(tmp_directory, sidecar_filename),
+                       value,
+                       allow_pickle=False)
+            sidecar_filenames.append(sidecar_filename)
+
+            return ('npy', sidecar_filename)
+
+        return None
+
+    fd, tmp_filename = tempfile.mkstemp(dir=parent_directory)
+
+    try:
+
+        with os.fdopen(fd, 'wb') as f:
+            pickler = pickle.Pickler(f, 2)
+            pickler.persistent_id = persistent_id
+            pickler.dump(obj)
+
+        if os.path.exists(sidecar_directory):
+            shutil.rmtree(sidecar_directory)
+
+        if sidecar_filenames:
+            set_default_permissions(tmp_directory)
+            os.rename(tmp_directory, sidecar_directory)
+        else:
+            os.rmdir(tmp_directory)
+
+        set_default_permissions(tmp_filename)
+        os.rename(tmp_filename, filename)
+
+    except:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+def load_pkl(filename, mmap_mode='c'):
+
+    '''
+    Load a pickle file written by save_pkl or dump_pkl. The sidecar arrays
+    of the latter are memory-mapped with `mmap_mode`, or loaded if it is
+    None. By default they are copy-on-write, so they can be modified
+    without changing the files.
+    '''
+
+    sidecar_directory = get_sidecar_directory(filename)
+
+    def persistent_load(persistent_id):
+
+        kind, sidecar_filename = persistent_id
+        assert kind == 'npy', 'Unknown sidecar %s.' % kind
+
+        return numpy.load(os.path.join(sidecar_directory, sidecar_filename),
+                          mmap_mode=mmap_mode)
 
-def load_pkl(filename):
     with open(filename, 'rb') as f:
-        return pickle.load(f)
+        unpickler = pickle.Unpickler(f)
+        unpickler.persistent_load = persistent_load
+        return unpickler.load()
+
+
+memoize_directory = 'memoize'
+memoize_index_filename = 'index.json'
+memoize_lock_filename = 'index.lock'
+
+
+def _update_hash(h, value):
+
+    '''
+    Update the hash `h` with a description of `value` that does not depend on
+    its identity. An object can define a `memoize_key` method returning what
+    to hash in its place.
+    '''
+
+    if hasattr(value, 'memoize_key'):
+        h.update('memoize_key:%s.%s;' % (type(value).__module__,
+                                          type(value).__name__))
+        _update_hash(h, value.memoize_key())
+
+    elif isinstance(value, numpy.ndarray):
+        h.update('ndarray:%s:%r;' % (value.dtype.str, value.shape))
+        if value.dtype.hasobject:
+            _update_hash(h, value.tolist())
+        else:
+            h.update(numpy.ascontiguousarray(value).data)
+
+    elif isinstance(value, dict):
+        h.update('dict:%d;' % len(value))
+        for key in sorted(value):
+            _update_hash(h, key)
+            _update_hash(h, value[key])
+
+    elif isinstance(value, (list, tuple)):
+        h.update('%s:%d;' % (type(value).__name__, len(value)))
+        for item in value:
+            _update_hash(h, item)
+
+    elif isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        h.update('string:%d;%s' % (len(value), value))
+
+    elif value is None or isinstance(value, (bool, int, long, float)):
+        h.update('%s:%r;' % (type(value).__name__, value))
+
+    else:
+        h.update('pickle:%s;' % pickle.dumps(value, 2))
+
+
+def _iter_code_names(code):
+
+    for name in code.co_names:
+        yield name
+
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            for name in _iter_code_names(constant):
+                yield name
+
+
+def _get_code_dependencies(obj, package, dependencies):
+
+    '''
+    Add to `dependencies` the function or class `obj` and, recursively, the
+    functions and classes of `package` that its code refers to, either by
+    global name or as attributes of a module of the package.
+    '''
+
+    obj = getattr(obj, '__wrapped__', obj) # See through memoize.
+
+    name = '%s.%s' % (obj.__module__, obj.__name__)
+    if name in dependencies:
+        return
+
+    dependencies[name] = obj
+
+    functions = []
+
+    if inspect.isclass(obj):
+
+        for base in obj.__bases__:
+            if base.__module__.split('.')[0] == package:
+                _get_code_dependencies(base, package, dependencies)
+
+        for attribute in obj.__dict__.values():
+            attribute = getattr(attribute, '__func__', attribute) # Static and class methods
+            attribute = getattr(attribute, 'fget', attribute) # Properties
+            if inspect.isfunction(attribute):
+                functions.append(attribute)
+
+    elif inspect.isfunction(obj):
+        functions.append(obj)
+
+    for function in functions:
+
+        names = set(_iter_code_names(function.func_code))
+
+        for name in names:
+
+            value = function.func_globals.get(name)
+
+            if isinstance(value, types.ModuleType):
+                # Only look into the package's own modules, and never import
+                # a lazily imported module to do so.
+                if value.__name__.split('.')[0] != package or isinstance(value, _LazyModule):
+                    continue
+                values = [value.__dict__.get(attribute) for attribute in names]
+            else:
+                values = [value]
+
+            for value in values:
+                if ((inspect.isfunction(value) or inspect.isclass(value))
+                    and value.__module__.split('.')[0] == package):
+                    _get_code_dependencies(value, package, dependencies)
+
+
+def get_code_key(obj):
+
+    '''
+    Return a hash of the source code of the function or class `obj` and of
+    every function and class of its package that it uses, directly or
+    indirectly, so that the key changes whenever any code that `obj` runs in
+    the package is edited.
+    '''
+
+    obj = getattr(obj, '__func__', obj) # Bound methods.
+
+    dependencies = {}
+    _get_code_dependencies(obj, obj.__module__.split('.')[0], dependencies)
+
+    h = hashlib.sha256()
+
+    for name in sorted(dependencies):
+
+        h.update('%s;' % name)
+
+        try:
+            h.update(inspect.getsource(dependencies[name]))
+        except (IOError, TypeError):
+            h.update(dependencies[name].func_code.co_code)
+
+    return h.hexdigest()
+
+
+def _read_memoize_index(directory):
+
+    try:
+        with open(os.path.join(directory, memoize_index_filename)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_memoize_index(directory, index):
+
+    fd, tmp_filename = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+
+    set_default_permissions(tmp_filename)
+    os.rename(tmp_filename, os.path.join(directory, memoize_index_filename))
+
+
+@contextlib.contextmanager
+def _lock_memoize_index(directory):
+
+    '''
+    Hold an exclusive lock on the memoize directory, for reading, changing
+    and writing back its index, and for adding, loading or removing results,
+    without racing other processes.
+    '''
+
+    with open(os.path.join(directory, memoize_lock_filename), 'a') as f:
+
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _get_size(filename):
+
+    size = os.path.getsize(filename)
+
+    sidecar_directory = get_sidecar_directory(filename)
+    if os.path.exists(sidecar_directory):
+        size += sum(os.path.getsize(os.path.join(sidecar_directory, sidecar))
+                    for sidecar in os.listdir(sidecar_directory))
+
+    return size
+
+
+def _remove_memoized(directory, key):
+
+    filename = os.path.join(directory, key + '.pkl')
+
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    shutil.rmtree(get_sidecar_directory(filename), ignore_errors=True)
+
+
+def memoize(cache='_cache', input_files=None, max_bytes=None, mmap_mode='c',
+            threshold=1 << 20):
+
+    '''
+    A decorator that stores the results of a function in the cache directory,
+    and returns the stored result when it is called again with the same
+    arguments.
+
+    A result is keyed by a hash of the function's code and the code it uses,
+    given by get_code_key, of its arguments (and of the object of a bound
+    method), and of the checksums of its input files. `input_files` is a
+    list of filenames, or a function returning them given the same
+    arguments.
+
+    Results are written with dump_pkl, and are always returned as loaded
+    back by load_pkl, with their arrays memory-mapped with `mmap_mode`, so
+    a result is the same kind of object whether or not it was computed. If
+    `max_bytes` is given, the least recently used results are removed once
+    they take up more than it. The index of the results is locked while it
+    is used, so several processes can share the cache.
+
+        @memoize(cache, max_bytes=10 * 2**30)
+        def get_cooccurrences(filename, cache, vocab): ...
+
+        posterior_prediction = memoize(cache)(predictive.posterior_prediction)
+
+    '''
+
+    directory = os.path.join(cache, memoize_directory)
+
+    def decorator(func):
+
+        function_key = get_code_key(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+
+            mkdir_p(directory)
+
+            h = hashlib.sha256()
+            h.update(function_key)
+            _update_hash(h, getattr(func, '__self__', None))
+            _update_hash(h, args)
+            _update_hash(h, kwargs)
+
+            if input_files is not None:
+
+                filenames = input_files(*args, **kwargs)\
+                    if callable(input_files) else input_files
+
+                checksum_cache = ChecksumCache(os.path.join(directory,
+                                                            checksum_cache_filename))
+                for filename in filenames:
+                    h.update(checksum_cache.checksum(filename))
+                checksum_cache.save()
+
+            key = h.hexdigest()
+            filename = os.path.join(directory, key + '.pkl')
+
+            with _lock_memoize_index(directory):
+
+                if os.path.exists(filename):
+
+                    result = load_pkl(filename, mmap_mode=mmap_mode)
+
+                    index = _read_memoize_index(directory)
+                    if key in index:
+                        index[key]['accessed'] = time.time()
+                        _write_memoize_index(directory, index)
+
+                    return result
+
+            # Compute and write the result without holding the lock. The
+            # write is atomic, so another process computing it too is safe.
+            dump_pkl(func(*args, **kwargs), filename, threshold=threshold)
+
+            with _lock_memoize_index(directory):
+
+                index = _read_memoize_index(directory)
+                index[key] = dict(function='%s.%s' % (func.__module__, func.__name__),
+                                  size=_get_size(filename),
+                                  accessed=time.time())
+
+                if max_bytes is not None:
+
+                    total = sum(entry['size'] for entry in index.values())
+
+                    for old_key in sorted(index, key=lambda k: index[k]['accessed']):
+
+                        if total <= max_bytes:
+                            break
+
+                        if old_key != key:
+                            total -= index[old_key]['size']
+                            _remove_memoized(directory, old_key)
+                            del index[old_key]
+
+                _write_memoize_index(directory, index)
+
+                return load_pkl(filename, mmap_mode=mmap_mode)
+
+        wrapper.__wrapped__ = func
+
+        return wrapper
+
+    return decorator
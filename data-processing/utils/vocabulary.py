@@ -0,0 +1,106 @@
+"""
+A vocabulary class shared by the text and data processing tools.
+
+"""
+
+#=============================================================================
+# Third party imports
+#=============================================================================
+import numpy
+
+#================================ End Imports ================================
+
+
+class Vocab(object):
+
+    '''
+    A vocabulary of unique words, where word i has index i.
+
+    The words are kept as a list and an array, and only these are pickled,
+    so a Vocab is cheap to send to worker processes. The `word2index` hash
+    is built the first time it is needed in a process.
+    '''
+
+    def __init__(self, vocab):
+
+        """
+        vocab should be a list
+
+        """
+
+        self.vocab = list(vocab)
+        self._words = None
+        self._word2index = None
+
+    def __getstate__(self):
+
+        return dict(vocab=self.vocab)
+
+    def __setstate__(self, state):
+
+        Vocab.__init__(self, state['vocab'])
+
+    def __len__(self):
+
+        return len(self.vocab)
+
+    def __contains__(self, word):
+
+        return word in self.word2index
+
+    @property
+    def word2index(self):
+
+        if self._word2index is None:
+
+            word2index = {word:i for i, word in enumerate(self.vocab)}
+            assert len(word2index) == len(self.vocab), 'Words are not unique.'
+
+            self._word2index = word2index
+
+        return self._word2index
+
+    @property
+    def index2word(self):
+
+        """
+        The list of words, which maps each index to its word.
+
+        """
+
+        return self.vocab
+
+    @property
+    def words(self):
+
+        """
+        The words as an object array, for vectorized lookups.
+
+        """
+
+        if self._words is None:
+            self._words = numpy.empty(len(self.vocab), dtype=object)
+            self._words[:] = self.vocab
+
+        return self._words
+
+    def encode(self, tokens, unknown=-1):
+
+        '''
+        Return the int32 array of the index of each of the tokens, with
+        `unknown` for those not in the vocabulary.
+        '''
+
+        get_index = self.word2index.get
+
+        return numpy.fromiter((get_index(token, unknown) for token in tokens),
+                              dtype=numpy.int32,
+                              count=len(tokens))
+
+    def decode(self, indices):
+
+        '''
+        Return the list of the words with the given indices.
+        '''
+
+        return self.words[numpy.asarray(indices, dtype=numpy.int64)].tolist()